@@ -0,0 +1,455 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import psutil
+import waitress
+import chardet
+import MeshedServer
+import MeshedStreamServer
+from MeshedServer import LogEventType
+
+def generate_log_lines (count, seed=0):
+    rng = random.Random (seed)
+
+    noise = [
+        "LogNet: NotifyAcceptingConnection accepted from: 203.0.113.{n}:7777",
+        "LogStreaming: Display: 0.{n} ms for processing 1 objects in RemoveUnreachableObjects(Queued=0, Async=0).",
+        "LogTemp: Warning: Sound class is missing on BP_Weapon_C_{n}",
+        "LogScript: Warning: Accessed None trying to read property CallFunc_GetPlayerCharacter_ReturnValue_{n}",
+        "LogBlueprintUserMessages: [BP_PandemicPlayerController_C_{n}] Inventory updated",
+        "LogPhysics: Warning: PHYSX: Scene {n} simulate called while still simulating",
+        "LogNetTraffic: Error: ReadContentBlockHeader: Stably named sub-object not found. Component: {n}",
+        "LogGameState: Match state changed to InProgress {n}"
+    ]
+
+    events = [
+        "LogObjectives: Completed Objective Obj_Reactor_{n} successfully",
+        "LogGameState: Unlocked Checkpoint CP_{n}",
+        "LogBlueprintUserMessages: Player Died",
+        "LogBlueprintUserMessages: Changing Game status to GS_PostGame",
+        "LogBlueprintUserMessages: Gamemode started",
+        "LogAIModule: Creating AISystem for world M_Site_{n}",
+        "LogLoad: Game class is 'BP_GameMode_Escape_C'",
+        "LogOnline: Create session complete",
+        "LogPandemic: Entering Standby, going to standby map M_ServerDefault.",
+        "LogNet: Login request: ?Name=Player{n} userId: Steam:UNKNOWN [0x1100001{n:08X}] platform: Steam",
+        "LogNet: UNetConnection::Close: [UNetConnection] RemoteAddr: 765611980{n:08d}:7777, Name: SteamNetConnection_{n}",
+        "LogPandemic: Successfully kicked player 765611980{n:08d}"
+    ]
+
+    lines = []
+    for index in range (count):
+        timestamp = f"[2024.05.12-10.{(index // 60) % 60:02d}.{index % 60:02d}:{index % 1000:03d}][{index % 1000:3d}]"
+        # Roughly 1 in 50 lines in a real Pandemic.log is something the manager cares about.
+        if rng.random () < 0.02:
+            template = rng.choice (events)
+        else:
+            template = rng.choice (noise)
+        lines.append (timestamp + template.format (n=rng.randint (0, 9999)))
+
+    return lines
+
+def read_log_lines (path):
+    with open (path, 'r', encoding='utf-8', errors='replace') as log_file:
+        return [line.rstrip ('\r\n') for line in log_file]
+
+def legacy_chain (line):
+    # The per-line checks analyze_log used to run, kept here as the baseline.
+    events = []
+
+    if MeshedServer.log_is_objective_completed (line):
+        events.append (LogEventType.OBJECTIVE_COMPLETED)
+    if MeshedServer.log_is_new_checkpoint (line):
+        events.append (LogEventType.CHECKPOINT)
+    if MeshedServer.log_has_player_died (line):
+        events.append (LogEventType.PLAYER_DIED)
+    if MeshedServer.log_has_game_ended (line):
+        events.append (LogEventType.GAME_ENDED)
+    if MeshedServer.log_is_game_started (line):
+        events.append (LogEventType.GAME_STARTED)
+    if MeshedServer.log_is_game_loading (line):
+        events.append (LogEventType.GAME_LOADING)
+    if MeshedServer.log_is_new_gamemode (line):
+        events.append (LogEventType.GAMEMODE)
+    if MeshedServer.log_is_session_creation (line):
+        events.append (LogEventType.SESSION_CREATED)
+    if MeshedServer.log_is_entering_idle (line):
+        events.append (LogEventType.SERVER_IDLE)
+    player_name, player_hex = MeshedServer.log_is_player_joined (line)
+    if player_hex:
+        events.append (LogEventType.PLAYER_JOINED)
+    if MeshedServer.log_is_player_leave (line):
+        events.append (LogEventType.PLAYER_LEFT)
+    MeshedServer.log_is_session_creation (line)
+
+    return events
+
+def time_lines (lines, function, repeat):
+    best = None
+    for _ in range (repeat):
+        start = time.perf_counter ()
+        for line in lines:
+            function (line)
+        elapsed = time.perf_counter () - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def check_parity (lines, matcher):
+    mismatches = 0
+    for line in lines:
+        legacy = legacy_chain (line)
+        event = matcher.match (line)
+        current = [event.type] if event else []
+        if legacy != current:
+            mismatches += 1
+            if mismatches <= 5:
+                print (f"  mismatch: {line!r} legacy={legacy} matcher={current}")
+
+    return mismatches
+
+def load_lines (args):
+    if args.log:
+        return read_log_lines (args.log)
+    return generate_log_lines (args.lines)
+
+def benchmark_matcher (args):
+    lines = load_lines (args)
+    matcher = MeshedServer.LogEventMatcher ()
+
+    print (f"Lines: {len (lines)}")
+    mismatches = check_parity (lines, matcher)
+    print (f"Parity mismatches: {mismatches}")
+
+    legacy_time = time_lines (lines, legacy_chain, args.repeat)
+    matcher_time = time_lines (lines, matcher.match, args.repeat)
+
+    print (f"log_is_* chain:   {len (lines) / legacy_time:>12,.0f} lines/sec")
+    print (f"LogEventMatcher:  {len (lines) / matcher_time:>12,.0f} lines/sec")
+    print (f"Speedup:          {legacy_time / matcher_time:>12.1f}x")
+
+def benchmark_replay (args):
+    if args.log:
+        result = MeshedServer.replay_log (args.log)
+    else:
+        result = replay_synthetic (args.lines)
+
+    MeshedServer.print_replay (result)
+
+def replay_synthetic (count):
+    with tempfile.TemporaryDirectory () as directory:
+        path = os.path.join (directory, "Pandemic.log")
+        with open (path, 'w', encoding='utf-8') as log_file:
+            log_file.write ('\n'.join (generate_log_lines (count)) + '\n')
+
+        return MeshedServer.replay_log (path)
+
+def run_suite (args):
+    logs = args.log or []
+    results = {}
+
+    for path in logs:
+        results[os.path.basename (path)] = suite_case (read_log_lines (path), MeshedServer.replay_log (path), args.repeat)
+    if not logs:
+        results[f"synthetic_{args.lines}"] = suite_case (generate_log_lines (args.lines), replay_synthetic (args.lines), args.repeat)
+
+    for name, result in results.items():
+        print (f"{name}")
+        for metric, value in result.items():
+            print (f"  {metric:<22} {value:>14,.2f}")
+
+    if args.output:
+        with open (args.output, 'w') as file:
+            json.dump (results, file, indent=4)
+
+    if args.baseline:
+        with open (args.baseline, 'r') as file:
+            baseline = json.load (file)
+
+        if compare_to_baseline (results, baseline, args.tolerance):
+            raise SystemExit (1)
+
+def suite_case (lines, replay, repeat):
+    matcher = MeshedServer.LogEventMatcher ()
+    matcher_time = time_lines (lines, matcher.match, repeat)
+
+    return {
+        "matcher_lines_per_second": len (lines) / matcher_time,
+        "replay_lines_per_second": replay['lines_per_second'],
+        "replay_events_per_second": replay['events_per_second'],
+        "replay_p50_us": replay['p50_ns'] / 1000,
+        "replay_p99_us": replay['p99_ns'] / 1000,
+        "events": replay['events']
+    }
+
+def compare_to_baseline (results, baseline, tolerance):
+    # Throughput should not drop and per line cost should not rise by more than the tolerance.
+    regressed = False
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for metric, value in result.items():
+            previous = baseline[name].get (metric)
+            if not previous or metric == "events":
+                continue
+
+            change = (value - previous) / previous
+            if metric.endswith ("_us"):
+                change = -change
+
+            if change < -tolerance:
+                regressed = True
+                print (f"REGRESSION {name} {metric}: {previous:,.2f} -> {value:,.2f} ({change:+.0%})")
+            elif change > tolerance:
+                print (f"Improved {name} {metric}: {previous:,.2f} -> {value:,.2f} ({change:+.0%})")
+
+        if result['events'] != baseline[name].get ('events', result['events']):
+            regressed = True
+            print (f"REGRESSION {name} events: {baseline[name]['events']} -> {result['events']}, the parser output changed")
+
+    return regressed
+
+def start_stream_server (args, broker):
+    def get_topic (path):
+        return "benchmark" if path == "/stream" else None
+
+    def not_found (environ, start_response):
+        start_response ('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b"Not found"]
+
+    if args.mode == "async":
+        server = MeshedStreamServer.StreamServer (not_found, broker, get_topic, lambda environ: True, "127.0.0.1", args.port, threads=8, max_streams=args.clients)
+        threading.Thread (target=server.serve, daemon=True).start ()
+        server.ready.wait ()
+        return
+
+    # What MeshedWebServer's stream routes do under waitress, one thread parked per stream.
+    def stream_app (environ, start_response):
+        if get_topic (environ['PATH_INFO']) is None:
+            return not_found (environ, start_response)
+
+        def generate():
+            subscriber = MeshedStreamServer.ThreadSubscriber ()
+            broker.subscribe ("benchmark", subscriber)
+            try:
+                version = 0
+                while True:
+                    events = broker.since ("benchmark", version)
+                    if events:
+                        version = events[-1][0]
+                        yield b"".join (payload for _, payload in events)
+                    subscriber.wait (MeshedStreamServer.StreamServer.keepalive_interval)
+            finally:
+                broker.unsubscribe ("benchmark", subscriber)
+
+        start_response ('200 OK', [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')])
+        return generate()
+
+    server = waitress.create_server (stream_app, host="127.0.0.1", port=args.port, threads=8)
+    threading.Thread (target=server.run, daemon=True).start ()
+
+async def stream_client (port, index, received, latencies):
+    reader, writer = await asyncio.open_connection ("127.0.0.1", port)
+    try:
+        writer.write (b"GET /stream HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n")
+        await writer.drain ()
+
+        while True:
+            line = await reader.readline ()
+            if not line:
+                break
+            if line.startswith (b"data: "):
+                data = json.loads (line[6:])
+                received[index] = data['sequence']
+                if data['sequence']:
+                    latencies.append (time.perf_counter () - data['published'])
+    finally:
+        writer.close ()
+
+async def wait_for_clients (received, clients, sequence, timeout):
+    deadline = time.perf_counter () + timeout
+    while time.perf_counter () < deadline:
+        if all (received[index] >= sequence for index in clients):
+            break
+        await asyncio.sleep (0.01)
+
+    return sum (1 for index in clients if received[index] >= sequence)
+
+async def run_stream_clients (args, broker, state):
+    received = {}
+    latencies = []
+
+    clients = []
+    for index in range (args.clients):
+        received[index] = -1
+        clients.append (asyncio.ensure_future (stream_client (args.port, index, received, latencies)))
+
+    connected = await wait_for_clients (received, received.keys(), 0, args.timeout)
+    process = psutil.Process ()
+
+    # Only clients that got the first payload are expected to see updates.
+    streaming = [index for index, value in received.items() if value >= 0]
+    delivered = 0
+    for sequence in range (1, args.updates + 1):
+        state['sequence'] = sequence
+        state['published'] = time.perf_counter ()
+        broker.publish ("benchmark")
+        delivered += await wait_for_clients (received, streaming, sequence, args.timeout)
+
+    result = {
+        "connected": connected,
+        "threads": threading.active_count (),
+        "rss_mb": process.memory_info ().rss / (1024 * 1024),
+        "delivered": delivered,
+        "expected": len (streaming) * args.updates,
+        "latencies": sorted (latencies)
+    }
+
+    for client in clients:
+        client.cancel ()
+    await asyncio.gather (*clients, return_exceptions=True)
+
+    return result
+
+def benchmark_streams (args):
+    broker = MeshedStreamServer.StreamBroker ()
+    state = {'sequence': 0, 'published': 0}
+    broker.register ("benchmark", lambda: {'sequence': state['sequence'], 'published': state['published'], 'padding': "x" * args.payload})
+
+    MeshedStreamServer.raise_open_file_limit ()
+    threads_before = threading.active_count ()
+    start_stream_server (args, broker)
+
+    result = asyncio.run (run_stream_clients (args, broker, state))
+    latencies = result['latencies']
+
+    print (f"Mode:                {args.mode}")
+    print (f"Clients:             {args.clients}")
+    print (f"Streams connected:   {result['connected']}")
+    print (f"Threads:             {threads_before} before, {result['threads']} while streaming")
+    print (f"Memory:              {result['rss_mb']:.1f} MB")
+    print (f"Updates delivered:   {result['delivered']} of {result['expected']}")
+    if latencies:
+        print (f"Fan-out latency:     p50 {latencies[len (latencies) // 2] * 1000:.2f}ms, p99 {latencies[int (len (latencies) * 0.99)] * 1000:.2f}ms, max {latencies[-1] * 1000:.2f}ms")
+
+    if result['connected'] < args.clients:
+        raise SystemExit (1)
+
+def generate_reports (directory, count, seed=0):
+    rng = random.Random (seed)
+    reasons = ["Cheating", "Griefing", "Toxicity", "Team killing", "Other"]
+    texts = ["he flies around the map", "kept shooting the team", "spamming voice chat", "Lässt niemanden durch", "стреляет в своих", "ずっと妨害している", ""]
+    # Mostly what the game writes, with a few files saved by hand in other encodings.
+    encodings = ["utf-16"] * 6 + ["utf-8", "utf-8-sig", "cp1252"]
+
+    for index in range (count):
+        encoding = rng.choice (encodings)
+        text = rng.choice (texts)
+        if encoding == "cp1252":
+            text = "Lässt niemanden durch"
+        contents = f"765611980{rng.randint (0, 99999999):08d},Target{index}\r\n765611981{rng.randint (0, 99999999):08d},Source{index % 50}\r\n" \
+                   f"2024.05.{index % 28 + 1:02d}-10.{index % 60:02d}.00\r\n\r\n{rng.choice (reasons)}\r\n{text} {index}\r\n"
+        with open (os.path.join (directory, f"Report_{index}.txt"), 'w', encoding=encoding, newline='') as file:
+            file.write (contents)
+
+def legacy_read_report (file_path):
+    # How search_directories used to read a report, kept here as the baseline.
+    with open (file_path, 'rb') as file:
+        raw_data = file.read ()
+    encoding = chardet.detect (raw_data)['encoding']
+    with open (file_path, 'r', encoding=encoding, errors='replace') as file:
+        return MeshedServer.UserReport.parse_report (file.read ())
+
+def benchmark_reports (args):
+    with tempfile.TemporaryDirectory () as directory:
+        reports_directory = os.path.join (directory, "Reports")
+        os.makedirs (reports_directory)
+        generate_reports (reports_directory, args.count)
+        file_paths = sorted (os.path.join (reports_directory, name) for name in os.listdir (reports_directory))
+
+        MeshedServer.data_dir = directory
+        MeshedServer.log_dir = directory
+
+        start = time.perf_counter ()
+        legacy = [legacy_read_report (file_path).hash for file_path in file_paths]
+        legacy_time = time.perf_counter () - start
+
+        start = time.perf_counter ()
+        current = [MeshedServer.UserReport.read_report_file (file_path).hash for file_path in file_paths]
+        current_time = time.perf_counter () - start
+
+        mismatches = sum (1 for old, new in zip (legacy, current) if old != new)
+
+        # The full scan, first with nothing cached and parse_backlog's threads, then again with everything cached.
+        sent = []
+        MeshedServer.send_new_reports = sent.append
+        MeshedServer.UserReport.register_reports_directory (reports_directory)
+
+        start = time.perf_counter ()
+        MeshedServer.UserReport.search_directories ()
+        cold_time = time.perf_counter () - start
+
+        start = time.perf_counter ()
+        MeshedServer.UserReport.search_directories ()
+        warm_time = time.perf_counter () - start
+
+    print (f"Reports:             {args.count}")
+    print (f"Hash mismatches:     {mismatches}")
+    print (f"Full chardet read:   {args.count / legacy_time:>10,.0f} reports/sec")
+    print (f"Fast path read:      {args.count / current_time:>10,.0f} reports/sec ({legacy_time / current_time:.1f}x)")
+    print (f"First scan:          {cold_time * 1000:>10,.1f} ms, {len (sent[0])} new reports")
+    print (f"Cached scan:         {warm_time * 1000:>10,.1f} ms")
+
+    if mismatches:
+        raise SystemExit (1)
+
+def main ():
+    parser = argparse.ArgumentParser (description="Meshed Server Tool benchmarks")
+    subparsers = parser.add_subparsers (dest="benchmark", required=True)
+
+    matcher_parser = subparsers.add_parser ("matcher", help="Compare the log event matcher against the old log_is_* chain")
+    matcher_parser.add_argument ("--log", help="Recorded Pandemic.log to run against. A synthetic log is generated if omitted.")
+    matcher_parser.add_argument ("--lines", type=int, default=200000, help="Number of synthetic lines to generate")
+    matcher_parser.add_argument ("--repeat", type=int, default=3, help="Runs per parser, the best one is reported")
+    matcher_parser.set_defaults (function=benchmark_matcher)
+
+    replay_parser = subparsers.add_parser ("replay", help="Replay a log through the analyze_log event pipeline and report throughput")
+    replay_parser.add_argument ("--log", help="Recorded Pandemic.log to replay. A synthetic log is generated if omitted.")
+    replay_parser.add_argument ("--lines", type=int, default=200000, help="Number of synthetic lines to generate")
+    replay_parser.set_defaults (function=benchmark_replay)
+
+    suite_parser = subparsers.add_parser ("suite", help="Run the parser benchmarks over one or more logs and compare against a baseline")
+    suite_parser.add_argument ("--log", action="append", help="Recorded Pandemic.log, can be given multiple times. A synthetic log is used if omitted.")
+    suite_parser.add_argument ("--lines", type=int, default=200000, help="Number of synthetic lines to generate")
+    suite_parser.add_argument ("--repeat", type=int, default=3, help="Runs of the matcher per log, the best one is reported")
+    suite_parser.add_argument ("--output", help="Write the results to this JSON file")
+    suite_parser.add_argument ("--baseline", help="Results JSON from an earlier run, exits with 1 on a regression")
+    suite_parser.add_argument ("--tolerance", type=float, default=0.15, help="Allowed relative change before a difference is reported")
+    suite_parser.set_defaults (function=run_suite)
+
+    streams_parser = subparsers.add_parser ("streams", help="Load test the dashboard streams with many concurrent connections")
+    streams_parser.add_argument ("--mode", choices=["async", "waitress"], default="async", help="Serve the streams with StreamServer or with waitress like web_server_mode = waitress")
+    streams_parser.add_argument ("--clients", type=int, default=250, help="Concurrent stream connections to open")
+    streams_parser.add_argument ("--updates", type=int, default=20, help="Updates to publish once every client is connected")
+    streams_parser.add_argument ("--payload", type=int, default=2000, help="Size of each update in bytes, about what a few servers' info comes to")
+    streams_parser.add_argument ("--port", type=int, default=5077, help="Local port for the test server")
+    streams_parser.add_argument ("--timeout", type=float, default=10, help="Seconds to wait for clients to connect and for each update to reach them")
+    streams_parser.set_defaults (function=benchmark_streams)
+
+    reports_parser = subparsers.add_parser ("reports", help="Time reading and scanning a directory of synthetic reports")
+    reports_parser.add_argument ("--count", type=int, default=10000, help="Number of report files to generate")
+    reports_parser.set_defaults (function=benchmark_reports)
+
+    args = parser.parse_args ()
+    args.function (args)
+
+if __name__ == "__main__":
+    main ()
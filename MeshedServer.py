@@ -1,7 +1,6 @@
 import re
 import subprocess
 import time
-import pygtail
 import threading
 import requests
 import json
@@ -14,12 +13,30 @@ from datetime import datetime, time, timedelta
 import time
 import shutil
 import socket
+import select
+import struct
+import ctypes
+import ctypes.util
 import traceback
 import hashlib
 import platformdirs
 import chardet
 from enum import Enum
 import logging
+import argparse
+import array
+import sqlite3
+import glob
+import queue
+import atexit
+import signal
+import sys
+import gzip
+import zlib
+import base64
+import binascii
+import codecs
+import concurrent.futures
 
 class OSErrorDetectionError (Exception):
     def __init__ (self, message="Either unable to detect the current OS or current OS is not supported."):
@@ -33,6 +50,1252 @@ class LogLevel (Enum):
     ERROR = 40
     CRITICAL = 50
 
+class LogTailer:
+    def __init__ (self, path):
+        self.path = path
+        self.reset ()
+
+        # Raises FileNotFoundError if the log has not been created yet.
+        self.update_identity (os.stat (self.path))
+
+    def reset (self):
+        self.offset = 0
+        self.inode = None
+        self.device = None
+        self.size = 0
+
+    def update_identity (self, stat):
+        self.inode = stat.st_ino
+        self.device = stat.st_dev
+        self.size = stat.st_size
+
+    def is_same_file (self, stat):
+        return stat.st_ino == self.inode and stat.st_dev == self.device
+
+    def read_lines (self):
+        try:
+            stat = os.stat (self.path)
+        except FileNotFoundError:
+            return
+
+        # The game rotates its log on every launch, start over if the file was replaced or truncated.
+        if not self.is_same_file (stat) or stat.st_size < self.offset:
+            self.offset = 0
+
+        self.update_identity (stat)
+
+        if stat.st_size == self.offset:
+            return
+
+        with open (self.path, 'rb') as log_file:
+            log_file.seek (self.offset)
+
+            for raw_line in log_file:
+                # Leave partially written lines for the next read.
+                if not raw_line.endswith (b'\n'):
+                    break
+
+                self.offset += len (raw_line)
+                yield raw_line.rstrip (b'\r\n').decode ('utf-8', errors='replace')
+
+class LogIndex:
+    # Where every line of log.txt starts, and which lines belong to each server, so a page of the log is one seek
+    # instead of a read of the whole file. Brought up to date from the bytes appended since the last call.
+    line_pattern = re.compile (rb'\[(.*?)\] (.*?) - (.*)')
+
+    def __init__ (self, path):
+        self.path = path
+        self.lock = threading.Lock ()
+        self.reset ()
+
+    def reset (self):
+        # Line n spans starts[n] to starts[n + 1]. The last line has no newline yet, it is kept in pending.
+        self.starts = array.array ('q', [0])
+        self.server_lines = {}
+        self.pending = b""
+        self.size = 0
+        self.inode = None
+        self.device = None
+
+    def get_server (self, raw_line):
+        match = LogIndex.line_pattern.match (raw_line)
+        if match:
+            return match.group (2).decode ('utf-8', errors='replace')
+        return None
+
+    def refresh (self):
+        # Must be called with the lock held.
+        try:
+            stat = os.stat (self.path)
+        except FileNotFoundError:
+            self.reset ()
+            return
+
+        # Rotated when the manager starts, index the new file from the beginning.
+        if stat.st_ino != self.inode or stat.st_dev != self.device or stat.st_size < self.size:
+            self.reset ()
+            self.inode = stat.st_ino
+            self.device = stat.st_dev
+
+        if stat.st_size == self.size:
+            return
+
+        with open (self.path, 'rb') as log_file:
+            log_file.seek (self.size)
+            data = log_file.read (stat.st_size - self.size)
+
+        buffer = self.pending + data
+        buffer_start = self.size - len (self.pending)
+
+        lines = buffer.split (b'\n')
+        self.pending = lines.pop ()
+
+        line_end = buffer_start
+        for line in lines:
+            match = LogIndex.line_pattern.match (line)
+            if match:
+                server = match.group (2).decode ('utf-8', errors='replace')
+                self.server_lines.setdefault (server, array.array ('q')).append (len (self.starts) - 1)
+
+            line_end += len (line) + 1
+            self.starts.append (line_end)
+
+        self.size += len (data)
+
+    def get_line_numbers (self, server):
+        # Must be called with the lock held.
+        if server is None:
+            return range (len (self.starts) - (0 if self.pending else 1))
+
+        numbers = self.server_lines.get (server, ())
+        if self.pending and self.get_server (self.pending) == server:
+            return LogIndex.ExtendedNumbers (numbers, len (self.starts) - 1)
+        return numbers
+
+    class ExtendedNumbers:
+        # A server's line numbers plus the unfinished last line, without copying them.
+        def __init__ (self, numbers, last):
+            self.numbers = numbers
+            self.last = last
+
+        def __len__ (self):
+            return len (self.numbers) + 1
+
+        def __getitem__ (self, page):
+            return list (self.numbers[page.start:page.stop]) + ([self.last] if page.stop == len (self) else [])
+
+    def line_count (self, server=None):
+        with self.lock:
+            self.refresh ()
+            return len (self.get_line_numbers (server))
+
+    def read_lines (self, log_file, first, last):
+        # Lines first to last, which are next to each other in the file.
+        base = self.starts[first]
+        end = self.starts[last + 1] if last + 1 < len (self.starts) else self.size
+        log_file.seek (base)
+        data = log_file.read (end - base)
+
+        lines = []
+        for number in range (first, last + 1):
+            line_end = self.starts[number + 1] if number + 1 < len (self.starts) else self.size
+            lines.append (data[self.starts[number] - base:line_end - base].decode ('utf-8', errors='replace'))
+        return lines
+
+    def get_lines (self, count, start=0, server=None):
+        # Newest first, start counts back from the end of the log.
+        with self.lock:
+            self.refresh ()
+
+            numbers = self.get_line_numbers (server)
+            newest = len (numbers) - start
+            if newest <= 0:
+                return []
+
+            page = numbers[max (newest - count, 0):newest]
+            if not page:
+                return []
+
+            try:
+                with open (self.path, 'rb') as log_file:
+                    if server is None:
+                        lines = self.read_lines (log_file, page[0], page[-1])
+                    else:
+                        lines = []
+                        for number in page:
+                            lines.extend (self.read_lines (log_file, number, number))
+            except FileNotFoundError:
+                return []
+
+        lines.reverse ()
+        return lines
+
+def read_log_tail (path, count, server=None, block_size=8192):
+    # The last count lines of a log, newest first, found by reading backwards from the end a block at a time.
+    # Lines keep their newline like readlines, so the result matches LogIndex.get_lines.
+    lines = []
+
+    with open (path, 'rb') as log_file:
+        position = log_file.seek (0, os.SEEK_END)
+
+        # The start of the oldest line seen so far, and what followed it in the file.
+        pending = b""
+        terminator = b""
+
+        while position > 0 and len (lines) < count:
+            read_size = min (block_size, position)
+            position -= read_size
+            log_file.seek (position)
+            data = log_file.read (read_size) + pending
+
+            pieces = data.split (b'\n')
+            terminators = [b'\n'] * (len (pieces) - 1) + [terminator]
+
+            # Unless this is the start of the file, the first piece may be part of a longer line.
+            if position > 0:
+                pending = pieces.pop (0)
+                terminator = terminators.pop (0)
+
+            for piece, piece_terminator in zip (reversed (pieces), reversed (terminators)):
+                raw_line = piece + piece_terminator
+                if not raw_line:
+                    continue
+
+                if server is not None:
+                    match = LogIndex.line_pattern.match (raw_line)
+                    if not match or match.group (2).decode ('utf-8', errors='replace') != server:
+                        continue
+
+                lines.append (raw_line.decode ('utf-8', errors='replace'))
+                if len (lines) >= count:
+                    break
+
+    return lines
+
+class EventStore:
+    # Everything write_to_log and write_to_log_error record, in SQLite so the web server can query it.
+    # WAL lets the web server read while the manager writes.
+    schema = """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            timestamp REAL NOT NULL,
+            server TEXT NOT NULL DEFAULT '',
+            severity TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            method TEXT NOT NULL DEFAULT '',
+            message TEXT NOT NULL,
+            data TEXT
+        );
+        CREATE INDEX IF NOT EXISTS events_server ON events (server, timestamp);
+        CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp);
+        CREATE INDEX IF NOT EXISTS events_severity ON events (severity, timestamp);
+        CREATE INDEX IF NOT EXISTS events_type ON events (event_type, timestamp);
+        CREATE TABLE IF NOT EXISTS imported_logs (
+            name TEXT PRIMARY KEY,
+            position INTEGER NOT NULL DEFAULT 0,
+            complete INTEGER NOT NULL DEFAULT 0
+        );
+    """
+
+    file_name = "events.db"
+    timestamp_format = "%d-%m-%Y %Hh%M"
+    line_pattern = re.compile (r'\[(.*?)\] (.*?) - (.*)')
+    severity_pattern = re.compile (r'\[(DEBUG|INFO|WARNING|ERROR|CRITICAL)\]\s*(.*?)\s*(?:\((.*)\))?$')
+
+    # What the register_* functions write, so imported logs get the same event types as new ones.
+    message_types = [
+        ('player_join', re.compile (r'Player .* \[.*\] connected\.$')),
+        ('player_leave', re.compile (r'Player .* \[.*\] has disconnected\.$')),
+        ('server_restart', re.compile (r'Server restarted for: ')),
+        ('server_start', re.compile (r'Server started\.$')),
+        ('server_active', re.compile (r'Server active\.$')),
+        ('server_stop', re.compile (r'Server stopped\.$')),
+        ('server_offline', re.compile (r'Server offline\.$')),
+        ('server_suspend', re.compile (r'Server suspended\.$')),
+        ('server_wake', re.compile (r'Server waking from suspension\.$')),
+        ('server_idle', re.compile (r'Server is now idle\.$')),
+        ('server_resumed', re.compile (r'Re-attached to running server\.$')),
+        ('server_creating', re.compile (r'Server is being created for the first time\.$')),
+        ('server_created', re.compile (r'Server successfully created\.$')),
+        ('game_change', re.compile (r'Game changed to ')),
+        ('checkpoint', re.compile (r'Activated checkpoint ')),
+        ('objective_completed', re.compile (r'Completed objective ')),
+        ('player_died', re.compile (r'Player died\.$')),
+        ('game_ended', re.compile (r'Game ended\.$')),
+        ('game_started', re.compile (r'Game started\.$')),
+        ('game_loading', re.compile (r'Loading ')),
+        ('gamemode_loading', re.compile (r'Gamemode: ')),
+        ('session_created', re.compile (r'Session created\. Now idling\.$')),
+        ('server_empty', re.compile (r'Server empty\.$'))
+    ]
+
+    def __init__ (self, path):
+        self.path = path
+        self.lock = threading.Lock ()
+        self.connection = sqlite3.connect (path, check_same_thread=False)
+        self.connection.execute ("PRAGMA journal_mode=WAL")
+        self.connection.execute ("PRAGMA synchronous=NORMAL")
+        self.connection.executescript (EventStore.schema)
+
+    def add_events (self, events):
+        # events are (timestamp, server, severity, event_type, method, message, data) tuples.
+        with self.lock, self.connection:
+            self.connection.executemany ("INSERT INTO events (timestamp, server, severity, event_type, method, message, data) VALUES (?, ?, ?, ?, ?, ?, ?)", events)
+
+    def add_event (self, server, severity, event_type, message, method="", data=None, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time ()
+        self.add_events ([(timestamp, server, severity, event_type, method, message, json.dumps (data) if data is not None else None)])
+
+    def checkpoint (self):
+        # Folds the WAL back into the database file.
+        with self.lock:
+            self.connection.execute ("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    @staticmethod
+    def build_filter (server=None, filters=None):
+        # filters can hold server, severity and event_type (a name or a list of them), start and end
+        # (unix timestamps) and text, which the message has to contain.
+        filters = dict (filters or {})
+        if server is not None:
+            filters['server'] = server
+
+        clauses = []
+        parameters = []
+
+        if filters.get ('server') is not None:
+            clauses.append ("server = ?")
+            parameters.append (filters['server'])
+
+        for field in ('severity', 'event_type'):
+            values = filters.get (field)
+            if not values:
+                continue
+            if isinstance (values, str):
+                values = [values]
+            clauses.append (f"{field} IN ({', '.join ('?' * len (values))})")
+            parameters += list (values)
+
+        if filters.get ('start') is not None:
+            clauses.append ("timestamp >= ?")
+            parameters.append (float (filters['start']))
+        if filters.get ('end') is not None:
+            clauses.append ("timestamp <= ?")
+            parameters.append (float (filters['end']))
+
+        if filters.get ('text'):
+            escaped = filters['text'].replace ('\\', '\\\\').replace ('%', '\\%').replace ('_', '\\_')
+            clauses.append ("message LIKE ? ESCAPE '\\'")
+            parameters.append (f"%{escaped}%")
+
+        return clauses, parameters
+
+    def get_events (self, count, start=0, server=None, filters=None):
+        # Newest first. Imported logs are written after newer events, so this goes by timestamp rather than id.
+        clauses, parameters = EventStore.build_filter (server, filters)
+
+        query = "SELECT timestamp, server, severity, event_type, method, message FROM events"
+        if clauses:
+            query += " WHERE " + " AND ".join (clauses)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+        parameters += [count, start]
+
+        with self.lock:
+            return self.connection.execute (query, parameters).fetchall ()
+
+    def count_events (self, server=None, filters=None):
+        clauses, parameters = EventStore.build_filter (server, filters)
+
+        query = "SELECT COUNT(*) FROM events"
+        if clauses:
+            query += " WHERE " + " AND ".join (clauses)
+
+        with self.lock:
+            return self.connection.execute (query, parameters).fetchone ()[0]
+
+    @staticmethod
+    def encode_cursor (timestamp, event_id):
+        return base64.urlsafe_b64encode (json.dumps ([timestamp, event_id]).encode ('utf-8')).decode ('ascii')
+
+    @staticmethod
+    def decode_cursor (cursor):
+        # Raises ValueError for anything that isn't a cursor from encode_cursor.
+        try:
+            timestamp, event_id = json.loads (base64.urlsafe_b64decode (cursor.encode ('ascii')))
+            return float (timestamp), int (event_id)
+        except (TypeError, AttributeError, UnicodeError, binascii.Error, json.JSONDecodeError) as e:
+            raise ValueError (f"Invalid cursor: {e}")
+
+    def query_events (self, filters=None, before=None, after=None, limit=100):
+        # Newest first. A cursor marks a position by timestamp and id, so pages don't shift when new events arrive.
+        clauses, parameters = EventStore.build_filter (filters=filters)
+        order = "DESC"
+
+        if before is not None:
+            timestamp, event_id = EventStore.decode_cursor (before)
+            clauses.append ("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            parameters += [timestamp, timestamp, event_id]
+        elif after is not None:
+            timestamp, event_id = EventStore.decode_cursor (after)
+            clauses.append ("(timestamp > ? OR (timestamp = ? AND id > ?))")
+            parameters += [timestamp, timestamp, event_id]
+            order = "ASC"
+
+        query = "SELECT id, timestamp, server, severity, event_type, method, message, data FROM events"
+        if clauses:
+            query += " WHERE " + " AND ".join (clauses)
+        query += f" ORDER BY timestamp {order}, id {order} LIMIT ?"
+        parameters.append (limit)
+
+        with self.lock:
+            rows = self.connection.execute (query, parameters).fetchall ()
+
+        # Events after a cursor are the ones closest to it, still returned newest first.
+        if order == "ASC":
+            rows.reverse ()
+
+        return [EventStore.event_to_dict (row) for row in rows]
+
+    @staticmethod
+    def event_to_dict (row):
+        event_id, timestamp, server, severity, event_type, method, message, data = row
+        return {
+            "id": event_id,
+            "cursor": EventStore.encode_cursor (timestamp, event_id),
+            "timestamp": timestamp,
+            "server": server,
+            "severity": severity,
+            "event_type": event_type,
+            "method": method,
+            "message": message,
+            "data": json.loads (data) if data else None,
+            "line": EventStore.format_event ((timestamp, server, severity, event_type, method, message))
+        }
+
+    @staticmethod
+    def format_event (row):
+        # The same line write_to_log has always put in log.txt.
+        timestamp, server, severity, event_type, method, message = row
+        formatted_datetime = datetime.fromtimestamp (timestamp).strftime (EventStore.timestamp_format)
+
+        if event_type != 'error':
+            return f"[{formatted_datetime}] {server} - {message}"
+
+        line = f"[{formatted_datetime}] [{severity}]"
+        if server != "":
+            line += f" {server}"
+        if method != "":
+            line += f" ({method})"
+        return line + f" - {message}"
+
+    def get_lines (self, count, start=0, server=None, filters=None):
+        return [EventStore.format_event (row) for row in self.get_events (count, start, server, filters)]
+
+    def get_import_position (self, name):
+        # How far into an archive the import got, None once it is complete.
+        with self.lock:
+            row = self.connection.execute ("SELECT position, complete FROM imported_logs WHERE name = ?", (name,)).fetchone ()
+
+        if row is None:
+            return 0
+        return None if row[1] else row[0]
+
+    def add_imported_events (self, name, events, position, complete=False):
+        # The events and how far the import got are saved together, an interrupted import carries on without duplicates.
+        with self.lock, self.connection:
+            self.connection.executemany ("INSERT INTO events (timestamp, server, severity, event_type, method, message, data) VALUES (?, ?, ?, ?, ?, ?, ?)", events)
+            self.connection.execute ("INSERT OR REPLACE INTO imported_logs (name, position, complete) VALUES (?, ?, ?)", (name, position, int (complete)))
+
+    def mark_imported (self, name):
+        self.add_imported_events (name, [], 0, complete=True)
+
+    def archive_mirrored_log (self, archive_name):
+        # log.txt was written while the store was open, so its archive is already in here.
+        with self.lock, self.connection:
+            mirrored = self.connection.execute ("DELETE FROM imported_logs WHERE name = 'log.txt' AND complete = 1").rowcount
+            if mirrored:
+                self.connection.execute ("INSERT OR REPLACE INTO imported_logs (name, position, complete) VALUES (?, 0, 1)", (archive_name,))
+
+    @staticmethod
+    def parse_log_line (line, last_timestamp):
+        match = EventStore.line_pattern.match (line)
+        if not match:
+            return None
+
+        written, source, message = match.groups ()
+        try:
+            timestamp = datetime.strptime (written, EventStore.timestamp_format).timestamp ()
+        except ValueError:
+            timestamp = last_timestamp
+
+        severity_match = EventStore.severity_pattern.match (source)
+        if severity_match:
+            severity, server, method = severity_match.groups ()
+            return (timestamp, server, severity, 'error', method or "", message, None)
+
+        event_type = 'log'
+        for message_type, pattern in EventStore.message_types:
+            if pattern.match (message):
+                event_type = message_type
+                break
+
+        return (timestamp, source, LogLevel.INFO.name, event_type, "", message, None)
+
+    def import_log_file (self, path, batch_size=5000):
+        # Compressed archives count as the same log, so one imported before it was compressed isn't imported again.
+        name = os.path.basename (path).removesuffix (".gz")
+        position = self.get_import_position (name)
+        if position is None:
+            return 0
+
+        imported = 0
+        last_timestamp = os.path.getmtime (path)
+        batch = []
+
+        with LogArchive.open_segment (path) as log_file:
+            log_file.seek (position)
+
+            for raw_line in log_file:
+                position += len (raw_line)
+
+                event = EventStore.parse_log_line (raw_line.rstrip (b'\r\n').decode ('utf-8', errors='replace'), last_timestamp)
+                if event is None:
+                    continue
+
+                last_timestamp = event[0]
+                batch.append (event)
+                if len (batch) >= batch_size:
+                    self.add_imported_events (name, batch, position)
+                    imported += len (batch)
+                    batch = []
+
+        self.add_imported_events (name, batch, position, complete=True)
+        imported += len (batch)
+
+        return imported
+
+    def import_log_directory (self, directory):
+        imported = 0
+        paths = glob.glob (os.path.join (directory, "log_*.txt")) + glob.glob (os.path.join (directory, "log_*.txt.gz"))
+
+        def modified (path):
+            try:
+                return os.path.getmtime (path)
+            except FileNotFoundError:
+                return 0
+
+        for path in sorted (paths, key=modified):
+            # A log compressed in the background since the glob is imported from its .gz, the position carries over.
+            for candidate in (path, path + ".gz") if not path.endswith (".gz") else (path,):
+                try:
+                    imported += self.import_log_file (candidate)
+                    break
+                except FileNotFoundError:
+                    continue
+                except (OSError, EOFError) as e:
+                    write_to_log_error (f"Could not import {candidate}. {e}", LogLevel.ERROR, method="EventStore.import_log_directory()")
+                    break
+        return imported
+
+class LogArchive:
+    # Rotated log.txt segments, gzipped, and a manifest of the time range each one covers,
+    # so a history query only opens the segments that overlap it.
+    manifest_name = "log_manifest.json"
+
+    def __init__ (self, directory, on_warning=None):
+        self.directory = directory
+        self.manifest_path = os.path.join (directory, LogArchive.manifest_name)
+        self.lock = threading.RLock ()
+        # The web server reads the archive too, without a log writer of its own it reports warnings here.
+        self.on_warning = on_warning
+
+    def warn (self, message, method):
+        if self.on_warning is not None:
+            self.on_warning (message)
+        else:
+            write_to_log_error (message, LogLevel.WARNING, method=method)
+
+    def load_manifest (self):
+        try:
+            with open (self.manifest_path, 'r') as file:
+                return json.load (file)['segments']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return []
+
+    def save_manifest (self, segments):
+        temp_path = self.manifest_path + ".tmp"
+        with open (temp_path, 'w') as file:
+            json.dump ({"segments": segments}, file, indent=4)
+        os.replace (temp_path, self.manifest_path)
+
+    @staticmethod
+    def open_segment (path):
+        if path.endswith (".gz"):
+            return gzip.open (path, 'rb')
+        return open (path, 'rb')
+
+    @staticmethod
+    def scan (lines):
+        start = end = None
+        count = 0
+        for raw_line in lines:
+            count += 1
+            match = EventStore.line_pattern.match (raw_line.decode ('utf-8', errors='replace'))
+            if not match:
+                continue
+            try:
+                timestamp = datetime.strptime (match.group (1), EventStore.timestamp_format).timestamp ()
+            except ValueError:
+                continue
+            if start is None:
+                start = timestamp
+            end = timestamp
+        return start, end, count
+
+    def add_segment (self, path):
+        with LogArchive.open_segment (path) as segment:
+            start, end, count = LogArchive.scan (segment)
+
+        # A segment without a single timestamped line is placed at the time it was last written.
+        if start is None:
+            start = end = os.path.getmtime (path)
+
+        with self.lock:
+            segments = [segment for segment in self.load_manifest () if segment['file'] != os.path.basename (path)]
+            segments.append ({
+                "file": os.path.basename (path),
+                "start": start,
+                "end": end,
+                "size": os.path.getsize (path),
+                "lines": count
+            })
+            segments.sort (key=lambda segment: segment['start'])
+            self.save_manifest (segments)
+
+    def compress (self, path):
+        compressed_path = path + ".gz"
+        temp_path = compressed_path + ".tmp"
+
+        # Held throughout, the startup sweep and a rotation can both pick up the same archive.
+        with self.lock:
+            try:
+                with open (path, 'rb') as source, gzip.open (temp_path, 'wb') as target:
+                    shutil.copyfileobj (source, target)
+            except FileNotFoundError:
+                return
+
+            os.replace (temp_path, compressed_path)
+            self.add_segment (compressed_path)
+            os.remove (path)
+
+    def compress_pending (self):
+        # Archives from before rotation existed, or whose compression was cut short.
+        known = {segment['file'] for segment in self.load_manifest ()}
+
+        for path in glob.glob (os.path.join (self.directory, "log_*.txt")):
+            self.compress (path)
+        for path in glob.glob (os.path.join (self.directory, "log_*.txt.gz")):
+            if os.path.basename (path) not in known:
+                self.add_segment (path)
+
+    def get_segments (self, start=None, end=None):
+        segments = []
+        for segment in self.load_manifest ():
+            if start is not None and segment['end'] < start:
+                continue
+            if end is not None and segment['start'] > end:
+                continue
+            segments.append (os.path.join (self.directory, segment['file']))
+        return segments
+
+    def read_history (self, start=None, end=None, server=None):
+        # Oldest first, log.txt last. Timestamps in the log only go down to the minute.
+        paths = self.get_segments (start, end) + [os.path.join (self.directory, "log.txt")]
+        last_timestamp = 0
+
+        for path in paths:
+            try:
+                segment = LogArchive.open_segment (path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                self.warn (f"Could not read {path}, skipping it. {e}", "LogArchive.read_history()")
+                continue
+
+            # A corrupt or truncated segment is skipped from where it broke, the rest of the history is still read.
+            try:
+                with segment:
+                    for raw_line in segment:
+                        event = EventStore.parse_log_line (raw_line.rstrip (b'\r\n').decode ('utf-8', errors='replace'), last_timestamp)
+                        if event is None:
+                            continue
+
+                        last_timestamp = event[0]
+                        if start is not None and event[0] < start:
+                            continue
+                        if end is not None and event[0] > end:
+                            continue
+                        if server is not None and event[1] != server:
+                            continue
+                        yield event
+            except (OSError, EOFError, zlib.error) as e:
+                self.warn (f"Could not read {path}, skipping it. {e}", "LogArchive.read_history()")
+
+class LogWriter:
+    # write_to_log only queues its line, this thread appends them to log.txt and the event store in batches.
+    flush_interval = 0.5
+    batch_size = 500
+
+    def __init__ (self):
+        self.queue = queue.Queue ()
+        self.thread = None
+
+    def start (self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread (target=self.run, daemon=True)
+        self.thread.start ()
+
+    def write (self, line, event):
+        # Before the thread is started, or after it stopped, write straight away.
+        if self.thread is None:
+            self.write_batch ([(line, event)])
+        else:
+            self.queue.put ((line, event))
+
+    def run (self):
+        while True:
+            item = self.queue.get ()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic () + LogWriter.flush_interval
+            stopping = False
+
+            while len (batch) < LogWriter.batch_size:
+                remaining = deadline - time.monotonic ()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get (timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append (item)
+
+            self.write_batch (batch)
+            rotate_log_file_if_due ()
+            if stopping:
+                break
+
+    def write_batch (self, batch, sync=False):
+        global log_dir
+
+        # The store is committed first. The web server rebuilds its log streams from it when log.txt changes,
+        # so the rows have to be there by the time the append wakes it.
+        events = [event for line, event in batch if event is not None]
+        if event_store is not None and events:
+            try:
+                event_store.add_events (events)
+            except sqlite3.Error as e:
+                # Not through write_to_log_error, it would end up back here.
+                logging.error (f"Could not write to the event store: {e}")
+
+        try:
+            with open (os.path.join (log_dir, "log.txt"), 'a') as log:
+                log.write (''.join (line for line, event in batch))
+                if sync:
+                    log.flush ()
+                    os.fsync (log.fileno ())
+        except OSError as e:
+            logging.error (f"Could not write to log.txt: {e}")
+
+    def stop (self):
+        # Writes whatever is still queued and syncs it to disk.
+        if self.thread is None:
+            return
+
+        self.queue.put (None)
+        self.thread.join ()
+        self.thread = None
+
+        remaining = []
+        while not self.queue.empty ():
+            item = self.queue.get ()
+            if item is not None:
+                remaining.append (item)
+        self.write_batch (remaining, sync=True)
+
+        if event_store is not None:
+            event_store.checkpoint ()
+
+class LogEventType (Enum):
+    OBJECTIVE_COMPLETED = 1
+    CHECKPOINT = 2
+    PLAYER_DIED = 3
+    GAME_ENDED = 4
+    GAME_STARTED = 5
+    GAME_LOADING = 6
+    GAMEMODE = 7
+    SESSION_CREATED = 8
+    SERVER_IDLE = 9
+    PLAYER_JOINED = 10
+    PLAYER_LEFT = 11
+
+class LogAction (Enum):
+    CONTINUE = 0
+    RESTART = 1
+    STOP = 2
+
+class LogEvent:
+    def __init__ (self, type, value=None, player_name=None):
+        self.type = type
+        self.value = value
+        self.player_name = player_name
+
+    def __repr__ (self):
+        return f"LogEvent(type={self.type.name}, value={self.value}, player_name={self.player_name})"
+
+class LogEventMatcher:
+    # Events that are always logged under a known category, matched against the message after "Category: ".
+    category_patterns = {
+        'LogObjectives': [
+            (LogEventType.OBJECTIVE_COMPLETED, r'Completed Objective (?P<value_0>.*?) successfully')
+        ],
+        'LogGameState': [
+            (LogEventType.CHECKPOINT, r'Unlocked Checkpoint (?P<value_1>.*)')
+        ],
+        'LogBlueprintUserMessages': [
+            (LogEventType.PLAYER_DIED, r'Player Died'),
+            (LogEventType.GAME_ENDED, r'Changing Game status to GS_PostGame'),
+            (LogEventType.GAME_STARTED, r'Gamemode started')
+        ],
+        'LogAIModule': [
+            (LogEventType.GAME_LOADING, r'Creating AISystem for world (?P<value_2>.*)')
+        ],
+        'LogLoad': [
+            (LogEventType.GAMEMODE, r'Game class is \'(?P<value_3>.*?)\'')
+        ],
+        'LogNet': [
+            (LogEventType.PLAYER_LEFT, r'UChannel::CleanUp: ChIndex == \d+. Closing connection. \[UChannel\] ChIndex: \d+, Closing: \d+ \[UNetConnection\] RemoteAddr: (?P<value_4>\d+):')
+        ]
+    }
+
+    # Events that can show up anywhere in a line, regardless of category.
+    # The literal is checked first so the regex only runs on lines that can match.
+    uncategorized_patterns = [
+        (LogEventType.SESSION_CREATED, 'Create session complete', r'Create session complete'),
+        (LogEventType.SERVER_IDLE, 'Entering Standby', r'Entering Standby, going to standby map M_ServerDefault.'),
+        (LogEventType.PLAYER_JOINED, '?Name=', r'\?Name=(?P<name>.*?) userId:.*?\[?(?P<value>0x[0-9A-Fa-f]+)\]'),
+        (LogEventType.PLAYER_LEFT, 'UNetConnection::Close', r'UNetConnection::Close: \[UNetConnection\] RemoteAddr: (?P<value>\d+):'),
+        (LogEventType.PLAYER_LEFT, 'Successfully kicked player', r'Successfully kicked player (?P<value>\d+)')
+    ]
+
+    def __init__ (self):
+        self.categories = {}
+        for category, patterns in LogEventMatcher.category_patterns.items():
+            # One alternation per category, the outer group name tells which event matched.
+            groups = [f"(?P<event_{index}>{pattern})" for index, (event_type, pattern) in enumerate (patterns)]
+            self.categories[category] = (re.compile ('|'.join (groups)), [event_type for event_type, pattern in patterns])
+
+        self.uncategorized = [
+            (literal, re.compile (pattern), event_type)
+            for event_type, literal, pattern in LogEventMatcher.uncategorized_patterns
+        ]
+
+    @staticmethod
+    def get_category (line):
+        # Unreal lines look like "[2024.01.01-00.00.00:000][  0]LogNet: message"
+        separator = line.find (': ')
+        if separator == -1:
+            return None, line
+
+        category_start = line.rfind (']', 0, separator) + 1
+        return line[category_start:separator], line[separator + 2:]
+
+    def match (self, line):
+        category, message = LogEventMatcher.get_category (line)
+
+        compiled = self.categories.get (category)
+        if compiled:
+            pattern, event_types = compiled
+            result = pattern.match (message)
+            if result:
+                event = LogEventMatcher.build_event (event_types[int (result.lastgroup[6:])], result)
+                if event:
+                    return event
+
+        for literal, pattern, event_type in self.uncategorized:
+            if literal in line:
+                result = pattern.search (line)
+                if result:
+                    return LogEventMatcher.build_event (event_type, result)
+
+        return None
+
+    @staticmethod
+    def build_event (event_type, result):
+        value = None
+        player_name = None
+        for name, group in result.groupdict().items():
+            if group is None or name.startswith ('event_'):
+                continue
+            if name.endswith ('name'):
+                player_name = group
+            else:
+                value = group
+
+        # The old log_is_* checks ignored empty captures.
+        if value == '':
+            return None
+
+        match event_type:
+            case LogEventType.GAME_LOADING:
+                if value == 'TransitionMap':
+                    return None
+            case LogEventType.PLAYER_JOINED:
+                value = log_get_steam_id_from_hex (value)
+
+        return LogEvent (event_type, value, player_name)
+
+class FileWatcher:
+    # inotify flags, see inotify(7)
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_IGNORED = 0x00008000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    poll_interval = 1
+
+    def __init__ (self):
+        # directory -> {file name: [callbacks]}
+        self.watches = {}
+        # directory -> [callbacks] for every file written in it
+        self.directory_watches = {}
+        self.lock = threading.Lock ()
+        self.start_lock = threading.Lock ()
+        self.thread = None
+
+        self.libc = None
+        self.inotify_fd = None
+        self.descriptors = {}
+        self.directory_descriptors = {}
+
+        # path -> (inode, size, mtime) for directories inotify can't watch
+        self.poll_state = {}
+
+    def watch_file (self, path, callback):
+        directory, name = os.path.split (os.path.abspath (path))
+
+        with self.lock:
+            self.watches.setdefault (directory, {}).setdefault (name, []).append (callback)
+            self.add_inotify_watch (directory)
+
+    def unwatch_file (self, path, callback):
+        directory, name = os.path.split (os.path.abspath (path))
+
+        with self.lock:
+            callbacks = self.watches.get (directory, {}).get (name)
+            if not callbacks or callback not in callbacks:
+                return
+
+            callbacks.remove (callback)
+            if not callbacks:
+                del self.watches[directory][name]
+                self.poll_state.pop (os.path.join (directory, name), None)
+
+            if not self.watches[directory]:
+                del self.watches[directory]
+                if directory not in self.directory_watches:
+                    self.remove_inotify_watch (directory)
+
+    def watch_directory (self, directory, callback):
+        # Called with the path of each file once it has been written and closed, or moved in.
+        # Needs inotify, without it whoever watches the directory has to scan it themselves.
+        directory = os.path.abspath (directory)
+
+        with self.lock:
+            self.directory_watches.setdefault (directory, []).append (callback)
+            self.add_inotify_watch (directory)
+
+    def unwatch_directory (self, directory, callback):
+        directory = os.path.abspath (directory)
+
+        with self.lock:
+            callbacks = self.directory_watches.get (directory)
+            if not callbacks or callback not in callbacks:
+                return
+
+            callbacks.remove (callback)
+            if not callbacks:
+                del self.directory_watches[directory]
+                if directory not in self.watches:
+                    self.remove_inotify_watch (directory)
+
+    def watched_directories (self):
+        return set (self.watches) | set (self.directory_watches)
+
+    def start (self):
+        # The web server and an embedded manager can both start it.
+        with self.start_lock:
+            if self.thread is not None:
+                return
+
+            self.init_inotify ()
+
+            if self.inotify_fd is not None:
+                with self.lock:
+                    for directory in self.watched_directories ():
+                        self.add_inotify_watch (directory)
+                self.thread = threading.Thread (target=self.inotify_loop, daemon=True)
+            else:
+                self.thread = threading.Thread (target=self.poll_loop, daemon=True)
+
+            self.thread.start ()
+
+    def init_inotify (self):
+        if platform.system () != "Linux":
+            return
+
+        try:
+            libc = ctypes.CDLL (ctypes.util.find_library ('c'), use_errno=True)
+            fd = libc.inotify_init1 (os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            write_to_log_error (f"inotify unavailable, falling back to polling. {e}", LogLevel.WARNING, method="FileWatcher.init_inotify()")
+            return
+
+        if fd < 0:
+            write_to_log_error (f"inotify_init1 failed with errno {ctypes.get_errno()}, falling back to polling.", LogLevel.WARNING, method="FileWatcher.init_inotify()")
+            return
+
+        self.libc = libc
+        self.inotify_fd = fd
+
+    def add_inotify_watch (self, directory):
+        if self.inotify_fd is None or directory in self.directory_descriptors:
+            return
+
+        wd = self.libc.inotify_add_watch (self.inotify_fd, os.fsencode (directory), FileWatcher.WATCH_MASK)
+
+        # Usually the directory doesn't exist yet, it is polled until it does.
+        if wd < 0:
+            return
+
+        self.descriptors[wd] = directory
+        self.directory_descriptors[directory] = wd
+
+    def remove_inotify_watch (self, directory):
+        wd = self.directory_descriptors.pop (directory, None)
+        if wd is None:
+            return
+
+        self.descriptors.pop (wd, None)
+        self.libc.inotify_rm_watch (self.inotify_fd, wd)
+
+    def get_callbacks (self, directory, name):
+        return list (self.watches.get (directory, {}).get (name, []))
+
+    def notify (self, callbacks, path):
+        for callback in callbacks:
+            try:
+                callback (path)
+            except Exception as e:
+                write_to_log_error (f"Error in watcher callback for {path}: {e}", LogLevel.ERROR, method="FileWatcher.notify()")
+
+    def inotify_loop (self):
+        last_poll = time.monotonic ()
+        while True:
+            readable, _, _ = select.select ([self.inotify_fd], [], [], FileWatcher.poll_interval)
+
+            if time.monotonic () - last_poll >= FileWatcher.poll_interval:
+                self.poll_unwatched_directories ()
+                last_poll = time.monotonic ()
+
+            if not readable:
+                continue
+
+            data = os.read (self.inotify_fd, 64 * 1024)
+            pending = []
+
+            with self.lock:
+                offset = 0
+                while offset < len (data):
+                    wd, mask, cookie, length = struct.unpack_from ('iIII', data, offset)
+                    name = os.fsdecode (data[offset + 16:offset + 16 + length].rstrip (b'\0'))
+                    offset += 16 + length
+
+                    directory = self.descriptors.get (wd)
+                    if directory is None:
+                        continue
+
+                    # The directory itself went away, poll for it to come back.
+                    if mask & (FileWatcher.IN_IGNORED | FileWatcher.IN_DELETE_SELF | FileWatcher.IN_MOVE_SELF):
+                        self.descriptors.pop (wd, None)
+                        self.directory_descriptors.pop (directory, None)
+                        continue
+
+                    if name:
+                        callbacks = self.get_callbacks (directory, name)
+                        if mask & (FileWatcher.IN_CLOSE_WRITE | FileWatcher.IN_MOVED_TO):
+                            callbacks += self.directory_watches.get (directory, [])
+                        if callbacks:
+                            pending.append ((callbacks, os.path.join (directory, name)))
+
+            for callbacks, path in pending:
+                self.notify (callbacks, path)
+
+    def poll_loop (self):
+        while True:
+            self.poll_unwatched_directories ()
+            time.sleep (FileWatcher.poll_interval)
+
+    def poll_unwatched_directories (self):
+        pending = []
+
+        with self.lock:
+            for directory in self.directory_watches:
+                self.add_inotify_watch (directory)
+
+            for directory, names in self.watches.items():
+                self.add_inotify_watch (directory)
+
+                if directory in self.directory_descriptors:
+                    continue
+
+                for name in names:
+                    path = os.path.join (directory, name)
+                    try:
+                        stat = os.stat (path)
+                        state = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                    except OSError:
+                        state = None
+
+                    if self.poll_state.get (path) != state:
+                        self.poll_state[path] = state
+                        pending.append ((self.get_callbacks (directory, name), path))
+
+        for callbacks, path in pending:
+            self.notify (callbacks, path)
+
+class ServerInfoPublisher:
+    # Changes within one window are sent to the web server as a single update.
+    window = 0.5
+
+    def __init__ (self):
+        self.dirty = threading.Event ()
+        self.thread = None
+
+        # What the web server has acknowledged, updates only carry the difference to it.
+        self.sent = {}
+        self.versions = {}
+        self.sequence = 0
+        self.full_sync = True
+
+    def mark_dirty (self):
+        self.dirty.set ()
+
+    def request_full_sync (self):
+        self.full_sync = True
+        self.mark_dirty ()
+
+    def build_update (self, current):
+        full = self.full_sync
+
+        servers = {}
+        for name, state in current.items():
+            change = ServerInfoPublisher.diff (None if full else self.sent.get (name), state)
+            if change:
+                change['version'] = self.versions.get (name, 0) + 1
+                servers[name] = change
+
+        removed = [] if full else [name for name in self.sent if name not in current]
+
+        if not full and not servers and not removed:
+            return None, current
+
+        update = {
+            "sequence": self.sequence + 1,
+            "previous_sequence": None if full else self.sequence,
+            "full": full,
+            "servers": servers,
+            "removed": removed
+        }
+        return update, current
+
+    def commit_update (self, update, current):
+        self.sequence = update['sequence']
+        self.sent = current
+        self.full_sync = False
+        for name, change in update['servers'].items():
+            self.versions[name] = change['version']
+
+    @staticmethod
+    def diff (previous, state):
+        if previous is None:
+            return {"set": state, "add": {}}
+
+        changed = {}
+        added = {}
+        for field, value in state.items():
+            old = previous.get (field)
+
+            # Player histories only grow between resets, send just the new entries.
+            if field in ServerInfo.growing_fields and old is not None:
+                old_items = set (old)
+                if old_items == set (value):
+                    continue
+                if old_items <= set (value):
+                    added[field] = [item for item in value if item not in old_items]
+                    continue
+            elif value == old:
+                continue
+
+            changed[field] = value
+
+        if not changed and not added:
+            return None
+
+        return {"set": changed, "add": added}
+
+    def start (self):
+        if self.thread is None:
+            self.thread = threading.Thread (target=self.run, daemon=True)
+            self.thread.start ()
+
+    def run (self):
+        while True:
+            self.dirty.wait ()
+            time.sleep (ServerInfoPublisher.window)
+            self.dirty.clear ()
+
+            try:
+                publish_server_info ()
+            except Exception as e:
+                write_to_log_error (f"Error publishing server info. {e}", LogLevel.ERROR, method="ServerInfoPublisher.run()")
+
+class AttachedProcess:
+    # Stands in for the Popen of a server launched by a previous run of the manager.
+    def __init__ (self, pid):
+        self.pid = pid
+        self.process = psutil.Process (pid)
+
+    def poll (self):
+        try:
+            if self.process.is_running () and self.process.status () != psutil.STATUS_ZOMBIE:
+                return None
+        except psutil.NoSuchProcess:
+            pass
+
+        return -1
+
 class Server:
     def __init__(self, name, config, server_info):
         self.name = name
@@ -44,13 +1307,17 @@ class Server:
         self.analysis_thread = None
         self.server_started = False
 
-        self.current_line = 0
         self.log_check_interval = int (read_global_config()['General']['log_checking_interval'])
+        self.checkpoint_interval = int (read_global_config()['General'].get('checkpoint_interval', 30))
+        self.last_checkpoint = time.monotonic()
         self.last_crash = None
         self.manual_kill_flag = False
         self.manual_shutdown_flag = False
 
         self.lock = threading.Lock()
+        # Held while the checkpoint is written or removed, so a save can't bring it back after kill_server removed it.
+        self.checkpoint_lock = threading.Lock()
+        self.log_changed = threading.Event()
 
     def create_server (self, shared_dir=False):
         self.server_info.server_status_change (-5)
@@ -66,7 +1333,7 @@ class Server:
         if not self.check_if_valid_install_dir():
             self.wait_for_valid_install_dir()
 
-        UserReport.register_reports_directory (os.path.join (self.saved_file_path, 'Reports'))
+        UserReport.register_reports_directory (os.path.join (self.saved_file_path, 'Reports'), self.name)
     
     def read_server_config (self):
         self.config = read_config (self.config_path)
@@ -153,9 +1420,25 @@ class Server:
             time.sleep (10)
 
     def start_log_analysis (self):
-        thread = threading.Thread (target=self.analyze_log, daemon=True)
+        thread = threading.Thread (target=self.watch_log, daemon=True)
         thread.start()
 
+    def watch_log (self):
+        log_file_path = self.log_file_path
+        file_watcher.watch_file (log_file_path, self.log_file_changed)
+
+        try:
+            self.analyze_log ()
+        finally:
+            file_watcher.unwatch_file (log_file_path, self.log_file_changed)
+
+    def log_file_changed (self, path):
+        self.log_changed.set ()
+
+    def wait_for_log_change (self, timeout):
+        # Cleared before the log is read, not here, so a change that arrives while reading still wakes the next wait.
+        self.log_changed.wait (timeout)
+
     def start_server (self):
         self.server_info.server_status_change (2)
         register_server_start (self.name)
@@ -268,7 +1551,9 @@ class Server:
             except psutil.NoSuchProcess:
                 pass
             finally:
-                self.server_process = None
+                with self.checkpoint_lock:
+                    self.server_process = None
+                    self.remove_checkpoint ()
 
     def suspend_server(self):
         self.shutdown_server()
@@ -295,8 +1580,7 @@ class Server:
         self.start_server()
         
     def idle_server (self):
-        self.server_info.server_status_change (4)
-        register_server_idle (self.name)
+        self.server_info.server_idle ()
 
     def server_crashed (self):
         self.last_crash = datetime.now().time()
@@ -305,9 +1589,9 @@ class Server:
         self.restart_server ("Server crash")
 
     def reset_vars(self):
-        self.log = None
+        if self.log is not None:
+            self.log.reset()
         self.server_info.reset_variables()
-        self.current_line = 0
         self.server_started = False
         self.last_crash = None
 
@@ -349,6 +1633,147 @@ class Server:
             
         return False
 
+    def get_checkpoint_path (self):
+        global data_dir
+
+        return os.path.join (data_dir, f"Server_{self.name}", "checkpoint.json")
+
+    def save_checkpoint (self):
+        with self.checkpoint_lock:
+            self.write_checkpoint ()
+
+    def write_checkpoint (self):
+        # Must be called with the checkpoint lock held.
+        if self.server_process is None or self.log is None:
+            return
+
+        try:
+            create_time = psutil.Process (self.server_process.pid).create_time()
+        except psutil.NoSuchProcess:
+            return
+
+        checkpoint = {
+            "pid": self.server_process.pid,
+            "create_time": create_time,
+            "server_started": self.server_started,
+            "log": {
+                "path": self.log.path,
+                "inode": self.log.inode,
+                "device": self.log.device,
+                "size": self.log.size,
+                "offset": self.log.offset
+            },
+            "server_info": self.server_info.to_snapshot()
+        }
+
+        # Write to a temporary file first so a crash mid-write never leaves a broken checkpoint.
+        checkpoint_path = self.get_checkpoint_path ()
+        temp_path = checkpoint_path + ".tmp"
+        try:
+            with open (temp_path, 'w') as file:
+                json.dump (checkpoint, file)
+            os.replace (temp_path, checkpoint_path)
+        except OSError as e:
+            write_to_log_error (f"Could not save checkpoint. {e}", LogLevel.WARNING, self.name, method="Server.save_checkpoint()")
+
+        self.last_checkpoint = time.monotonic()
+
+    def save_checkpoint_if_due (self):
+        if time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.save_checkpoint ()
+
+    def load_checkpoint (self):
+        checkpoint_path = self.get_checkpoint_path ()
+        if not os.path.isfile (checkpoint_path):
+            return None
+
+        try:
+            with open (checkpoint_path, 'r') as file:
+                return json.load (file)
+        except (OSError, ValueError) as e:
+            write_to_log_error (f"Could not read checkpoint. {e}", LogLevel.WARNING, self.name, method="Server.load_checkpoint()")
+            return None
+
+    def remove_checkpoint (self):
+        try:
+            os.remove (self.get_checkpoint_path ())
+        except OSError:
+            pass
+
+    def resume_from_checkpoint (self):
+        checkpoint = self.load_checkpoint ()
+        if checkpoint is None:
+            return False
+
+        # Only re-attach to the exact process that was running, not something that reused its pid.
+        try:
+            process = AttachedProcess (checkpoint['pid'])
+            if process.poll () is not None or process.process.create_time() != checkpoint['create_time']:
+                raise psutil.NoSuchProcess (checkpoint['pid'])
+        except psutil.Error:
+            self.remove_checkpoint ()
+            return False
+
+        self.server_process = process
+        self.server_started = checkpoint['server_started']
+        self.server_info.restore_snapshot (checkpoint['server_info'])
+
+        # Continue from the saved offset if the log is still the same file, otherwise read the new one from the start.
+        log_checkpoint = checkpoint['log']
+        try:
+            self.log = LogTailer (self.log_file_path)
+            if self.log.inode == log_checkpoint['inode'] and self.log.device == log_checkpoint['device'] and self.log.size >= log_checkpoint['offset']:
+                self.log.offset = log_checkpoint['offset']
+            else:
+                self.log.reset ()
+        except FileNotFoundError:
+            self.log = None
+
+        register_server_resumed (self.name)
+        self.start_log_analysis ()
+        return True
+
+    def handle_log_event (self, event):
+        self.server_info.apply_log_event (event)
+
+        match event.type:
+            # Is the next game loading?
+            case LogEventType.GAME_LOADING:
+                if self.manual_shutdown_flag:
+                    self.shutdown_server()
+                    return LogAction.STOP
+
+                if self.active_hours:
+                    if not self.is_active_hours ():
+                        self.suspend_server()
+                        return LogAction.STOP
+
+                if self.server_info.gamemode_changes > self.max_reloads:
+                    self.restart_server(f"Server reloaded {self.server_info.gamemode_changes} times")
+                    return LogAction.RESTART
+                elif self.restricted_gamemode != '':
+                    delimited_string = self.restricted_gamemode.split('?')
+                    if len (delimited_string) == 1:
+                        if self.server_info.current_game != delimited_string[0]:
+                            self.restart_server(f"Server loaded a gamemode that is not {self.restricted_gamemode}")
+                            return LogAction.RESTART
+
+            # Is a new gamemode?
+            case LogEventType.GAMEMODE:
+                delimited_string = self.restricted_gamemode.split('?')
+                if len (delimited_string) > 1:
+                    if self.server_info.current_game != delimited_string[0] or self.server_info.current_gamemode != delimited_string[1]:
+                        self.restart_server(f"Server loaded a gamemode that is not {self.restricted_gamemode}")
+                        return LogAction.RESTART
+
+            # Is this the first time the server has started? Init the server.
+            case LogEventType.SESSION_CREATED:
+                if not self.server_started:
+                    self.server_info.server_status_change (4)
+                    self.idle_server()
+                    self.server_started = True
+
+        return LogAction.CONTINUE
 
     def analyze_log(self):
         # If this starts when we are beyond the active hours, if it is, suspend.
@@ -363,11 +1788,14 @@ class Server:
             server_logging = True
 
             while server_logging and not self.manual_kill_flag:
-                time.sleep(3)
+                # Give the server a moment to create its log. Everything is read after this anyway.
+                self.log_changed.clear ()
+                self.wait_for_log_change (3)
 
                 # Setup the log file for reading
                 try:
-                    self.log = pygtail.Pygtail(self.log_file_path)
+                    if self.log is None:
+                        self.log = LogTailer (self.log_file_path)
                 except FileNotFoundError:
                     write_to_log_error (f"Log file {self.log_file_path} not found.", LogLevel.ERROR, self.name)
                     return
@@ -394,119 +1822,59 @@ class Server:
                         break
 
                     # Go through each new line 
-                    with open(self.log_file_path, 'r') as log_file:
-                        for _ in range(self.current_line):
-                            log_file.readline()
-
-                        for line in log_file:
-                            self.current_line += 1
-
-                            # Has an objective been completed?
-                            objective_completed = log_is_objective_completed (line)
-                            if objective_completed:
-                                self.server_info.objective_completed (objective_completed)
-
-                            # Has a checkpoint been reached? 
-                            checkpoint = log_is_new_checkpoint (line)
-                            if checkpoint:
-                                self.server_info.new_checkpoint (checkpoint)
-
-                            # Has a player died?
-                            player_death = log_has_player_died (line)
-                            if player_death:
-                                self.server_info.player_died ()
-
-                            # Has the game ended?
-                            game_ended = log_has_game_ended (line)
-                            if game_ended:
-                                self.server_info.game_ended ()
-
-                            # Has the game started?
-                            game_started = log_is_game_started (line)
-                            if game_started:
-                                self.server_info.game_started ()
-
-                            # Is the next game declared?
-                            # next_game = log_is_next_game (line)
-
-                            # Is the next game loading?
-                            game_loading = log_is_game_loading (line)
-                            if game_loading:
-                                self.server_info.game_loading (game_loading)
-                                
-                                if self.manual_shutdown_flag:
-                                    self.shutdown_server()
-                                    server_active = False
-                                    server_logging = False
-                                    break
-
-                                if self.active_hours:
-                                    if not self.is_active_hours ():
-                                        self.suspend_server()
-                                        server_active = False
-                                        server_logging = False
-                                        break
-
-                                if self.server_info.gamemode_changes > self.max_reloads:
-                                    self.restart_server(f"Server reloaded {self.server_info.gamemode_changes} times")
-                                    server_active = False
-                                    break
-                                elif self.restricted_gamemode != '':
-                                    delimited_string = self.restricted_gamemode.split('?')
-                                    if len (delimited_string) == 1:
-                                        if self.server_info.current_game != delimited_string[0]:
-                                            self.restart_server(f"Server loaded a gamemode that is not {self.restricted_gamemode}")
-                                            server_active = False
-                                            break
-
-                            # Is a new gamemode?
-                            gamemode = log_is_new_gamemode (line)
-                            if gamemode:
-                                self.server_info.new_gamemode (gamemode)
-
-                                delimited_string = self.restricted_gamemode.split('?')
-                                if len (delimited_string) > 1:
-                                    if self.server_info.current_game != delimited_string[0] or self.server_info.current_gamemode != delimited_string[1]:
-                                        self.restart_server(f"Server loaded a gamemode that is not {self.restricted_gamemode}")
-                                        server_active = False
-                                        break
-
-                            # Has session been created?
-                            session_create = log_is_session_creation (line)
-                            if session_create:
-                                self.server_info.session_created ()
-
-                            # Is server idling?
-                            server_idle = log_is_entering_idle (line)
-                            if server_idle:
-                                self.idle_server()
-
-                            # Is the latest log a player joining? Log it in the server info.
-                            player_name, player_hex = log_is_player_joined(line)
-                            if player_hex:
-                                player_id = log_get_steam_id_from_hex (player_hex)
-                                if player_id not in self.server_info.current_users:
-                                    self.server_info.player_join(player_id, player_name)
-
-                            # Is the latest log a player leaving? Log it in the server info.
-                            player_id = log_is_player_leave(line)
-                            if player_id:
-                                if player_id in self.server_info.current_users:
-                                    self.server_info.player_leave(player_id)
-  
-                            # Is this the first time the server has started? Init the server.
-                            if not self.server_started:
-                                session_create = log_is_session_creation (line)
-
-                                if session_create:
-                                    self.server_info.server_status_change (4)
-                                    self.idle_server()
-                                    self.server_started = True
+                    self.log_changed.clear ()
+                    if self.log is not None:
+                        for line in self.log.read_lines ():
+                            event = log_event_matcher.match (line)
+                            if event is None:
+                                continue
+
+                            action = self.handle_log_event (event)
+                            if action == LogAction.STOP:
+                                server_active = False
+                                server_logging = False
+                                break
+                            elif action == LogAction.RESTART:
+                                server_active = False
+                                break
                                 
                     send_server_info ()
-                    time.sleep(self.log_check_interval)
+                    self.save_checkpoint_if_due ()
+
+                    # Woken as soon as the log is appended to, the interval only paces the crash and idle checks.
+                    self.wait_for_log_change (self.log_check_interval)
+
+class ReplayServer (Server):
+    # Runs a recorded log through handle_log_event without launching anything.
+    # Restarts, shutdowns and suspensions are recorded instead of executed.
+    def __init__ (self, name, server_info, max_reloads=7, restricted_gamemode=''):
+        self.name = name
+        self.server_info = server_info
+        self.server_process = None
+        self.log = None
+        self.server_started = False
+        self.manual_kill_flag = False
+        self.manual_shutdown_flag = False
+        self.active_hours = False
+        self.max_reloads = max_reloads
+        self.restricted_gamemode = restricted_gamemode
+        self.actions = []
+
+    def restart_server (self, reason):
+        self.actions.append (f"restart: {reason}")
+        write_to_log (self.name, f"Server restarted for: {reason}.")
+
+    def shutdown_server (self):
+        self.actions.append ("shutdown")
+        write_to_log (self.name, "Server stopped.")
+
+    def suspend_server (self):
+        self.actions.append ("suspend")
+        write_to_log (self.name, "Server suspended.")
 
 class ServerInfo:
+    growing_fields = ('joined_users', 'disconnected_users')
+
     def __init__ (self, name):
         self.name = name
         self.server_restarts = 0
@@ -581,6 +1949,37 @@ class ServerInfo:
         self.server_status_change (4)
         register_session_created (self.name)
 
+    def server_idle (self):
+        self.server_status_change (4)
+        register_server_idle (self.name)
+
+    def apply_log_event (self, event):
+        match event.type:
+            case LogEventType.OBJECTIVE_COMPLETED:
+                self.objective_completed (event.value)
+            case LogEventType.CHECKPOINT:
+                self.new_checkpoint (event.value)
+            case LogEventType.PLAYER_DIED:
+                self.player_died ()
+            case LogEventType.GAME_ENDED:
+                self.game_ended ()
+            case LogEventType.GAME_STARTED:
+                self.game_started ()
+            case LogEventType.GAME_LOADING:
+                self.game_loading (event.value)
+            case LogEventType.GAMEMODE:
+                self.new_gamemode (event.value)
+            case LogEventType.SESSION_CREATED:
+                self.session_created ()
+            case LogEventType.SERVER_IDLE:
+                self.server_idle ()
+            case LogEventType.PLAYER_JOINED:
+                if event.value not in self.current_users:
+                    self.player_join (event.value, event.player_name)
+            case LogEventType.PLAYER_LEFT:
+                if event.value in self.current_users:
+                    self.player_leave (event.value)
+
     def reset_game_variables (self):
         self.player_deaths = 0
         self.current_checkpoint = None
@@ -618,6 +2017,64 @@ class ServerInfo:
         self.server_status = status_dict.get (new_status, 'Offline')
         send_server_info()
     
+    def to_dict (self):
+        return {
+            "server_name": self.name,
+            "current_game": self.current_game,
+            "current_gamemode": self.current_gamemode,
+            "current_checkpoint": self.current_checkpoint,
+            "last_completed_objective": self.last_completed_objective,
+            "previous_game": self.previous_game,
+            "joined_users": list(self.joined_users),
+            "disconnected_users": list(self.disconnected_users),
+            "current_users": dict(self.current_users),
+            "gamemode_changes": self.gamemode_changes,
+            "total_user_joins": self.total_user_joins,
+            "total_user_disconnects": self.total_user_disconnects,
+            "server_restarts": self.server_restarts,
+            "player_deaths": self.player_deaths,
+            "game_attempts": self.game_attempts,
+            "server_status": self.server_status
+        }
+
+    def to_snapshot (self):
+        return {
+            "current_game": self.current_game,
+            "current_gamemode": self.current_gamemode,
+            "previous_game": self.previous_game,
+            "current_checkpoint": self.current_checkpoint,
+            "last_completed_objective": self.last_completed_objective,
+            "joined_users": list(self.joined_users),
+            "disconnected_users": list(self.disconnected_users),
+            "current_users": self.current_users,
+            "gamemode_changes": self.gamemode_changes,
+            "total_user_joins": self.total_user_joins,
+            "total_user_disconnects": self.total_user_disconnects,
+            "server_restarts": self.server_restarts,
+            "player_deaths": self.player_deaths,
+            "game_attempts": self.game_attempts,
+            "idle_time": self.idle_time.isoformat() if self.idle_time else 0,
+            "server_status": self.server_status
+        }
+
+    def restore_snapshot (self, snapshot):
+        self.current_game = snapshot['current_game']
+        self.current_gamemode = snapshot['current_gamemode']
+        self.previous_game = snapshot['previous_game']
+        self.current_checkpoint = snapshot['current_checkpoint']
+        self.last_completed_objective = snapshot['last_completed_objective']
+        self.joined_users = set(snapshot['joined_users'])
+        self.disconnected_users = set(snapshot['disconnected_users'])
+        self.current_users = snapshot['current_users']
+        self.gamemode_changes = snapshot['gamemode_changes']
+        self.total_user_joins = snapshot['total_user_joins']
+        self.total_user_disconnects = snapshot['total_user_disconnects']
+        self.server_restarts = snapshot['server_restarts']
+        self.player_deaths = snapshot['player_deaths']
+        self.game_attempts = snapshot['game_attempts']
+        self.idle_time = datetime.fromisoformat (snapshot['idle_time']) if snapshot['idle_time'] else 0
+        self.server_status = snapshot['server_status']
+
     def __repr__(self):
         return f"ServerInfo(name={self.name}, " \
                f"previous_game={self.previous_game}, " \
@@ -635,9 +2092,239 @@ class ServerInfo:
                f"server_restarts={self.server_restarts}, " \
                f"server_status={self.server_status}) "
     
+class HandledReports:
+    # The hashes of handled reports, loaded once into a set. handled_reports.txt is an append log of them,
+    # a line starting with '-' takes a hash back out. Rewritten with only the current hashes once
+    # removed and repeated lines make up most of it.
+    compact_threshold = 256
+
+    def __init__ (self, path):
+        self.path = path
+        self.hashes = set ()
+        self.log_lines = 0
+        self.lock = threading.Lock ()
+        self.load ()
+
+    def load (self):
+        with self.lock:
+            self.hashes = set ()
+            self.log_lines = 0
+
+            try:
+                with open (self.path, 'r') as file:
+                    for line in file:
+                        line = line.strip ()
+                        if not line:
+                            continue
+                        self.log_lines += 1
+                        if line.startswith ('-'):
+                            self.hashes.discard (line[1:])
+                        else:
+                            self.hashes.add (line)
+            except FileNotFoundError:
+                pass
+
+            self.compact_if_due ()
+
+    def __contains__ (self, hash):
+        return hash in self.hashes
+
+    def __len__ (self):
+        return len (self.hashes)
+
+    def add (self, hash):
+        with self.lock:
+            if hash in self.hashes:
+                return False
+            self.append (hash)
+            self.hashes.add (hash)
+            return True
+
+    def remove (self, hash):
+        with self.lock:
+            if hash not in self.hashes:
+                return False
+            self.append ('-' + hash)
+            self.hashes.discard (hash)
+            self.compact_if_due ()
+            return True
+
+    def append (self, line):
+        # Must be called with the lock held.
+        with open (self.path, 'a') as file:
+            file.write (line + '\n')
+        self.log_lines += 1
+
+    def compact_if_due (self):
+        # Must be called with the lock held.
+        if self.log_lines - len (self.hashes) > max (HandledReports.compact_threshold, len (self.hashes)):
+            self.compact ()
+
+    def compact (self):
+        # Must be called with the lock held.
+        temp_path = self.path + ".tmp"
+        with open (temp_path, 'w') as file:
+            file.writelines (hash + '\n' for hash in self.hashes)
+        os.replace (temp_path, self.path)
+        self.log_lines = len (self.hashes)
+
+class ReportStore:
+    # Every report ever parsed, kept after the game's file is gone, so reports can be looked up by player,
+    # server and date. handled mirrors handled_reports.txt. WAL lets the web server read while the manager writes.
+    schema = """
+        CREATE TABLE IF NOT EXISTS reports (
+            hash TEXT PRIMARY KEY,
+            server TEXT NOT NULL DEFAULT '',
+            target TEXT NOT NULL,
+            target_id TEXT NOT NULL,
+            source TEXT NOT NULL,
+            source_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            reason TEXT NOT NULL,
+            text TEXT NOT NULL,
+            handled INTEGER NOT NULL DEFAULT 0,
+            handled_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS reports_target ON reports (target_id, timestamp);
+        CREATE INDEX IF NOT EXISTS reports_source ON reports (source_id, timestamp);
+        CREATE INDEX IF NOT EXISTS reports_server ON reports (server, timestamp);
+        CREATE INDEX IF NOT EXISTS reports_handled ON reports (handled, timestamp);
+        CREATE INDEX IF NOT EXISTS reports_timestamp ON reports (timestamp, target_id, source_id);
+    """
+
+    file_name = "reports.db"
+    # How the game writes the date line of a report.
+    date_format = "%Y.%m.%d-%H.%M.%S"
+    columns = ("hash", "server", "target", "target_id", "source", "source_id", "date", "timestamp", "reason", "text", "handled", "handled_at")
+
+    def __init__ (self, path):
+        self.path = path
+        self.lock = threading.Lock ()
+        self.connection = sqlite3.connect (path, check_same_thread=False)
+        self.connection.execute ("PRAGMA journal_mode=WAL")
+        self.connection.execute ("PRAGMA synchronous=NORMAL")
+        self.connection.executescript (ReportStore.schema)
+
+    @staticmethod
+    def parse_date (date):
+        try:
+            return datetime.strptime (date, ReportStore.date_format).timestamp ()
+        except ValueError:
+            return None
+
+    def add_reports (self, reports, handled=()):
+        # A report that is already stored keeps its handled state.
+        rows = []
+        now = time.time ()
+        for report in reports:
+            timestamp = ReportStore.parse_date (report.date) or now
+            is_handled = report.hash in handled
+            rows.append ((report.hash, getattr (report, 'server', '') or '', report.target, report.target_id, report.source, report.source_id,
+                          report.date, timestamp, report.reason, report.text, int (is_handled), now if is_handled else None))
+
+        with self.lock, self.connection:
+            self.connection.executemany (f"INSERT OR IGNORE INTO reports ({', '.join (ReportStore.columns)}) VALUES ({', '.join ('?' * len (ReportStore.columns))})", rows)
+
+    def set_handled (self, hash, handled=True):
+        with self.lock, self.connection:
+            self.connection.execute ("UPDATE reports SET handled = ?, handled_at = ? WHERE hash = ?", (int (handled), time.time () if handled else None, hash))
+
+    def delete (self, hash):
+        with self.lock, self.connection:
+            self.connection.execute ("DELETE FROM reports WHERE hash = ?", (hash,))
+
+    def get_report (self, hash):
+        with self.lock:
+            row = self.connection.execute (f"SELECT {', '.join (ReportStore.columns)} FROM reports WHERE hash = ?", (hash,)).fetchone ()
+        return ReportStore.row_to_dict (row) if row else None
+
+    @staticmethod
+    def row_to_dict (row):
+        report = dict (zip (ReportStore.columns, row))
+        report['handled'] = bool (report['handled'])
+        return report
+
+    @staticmethod
+    def build_filter (filters):
+        # filters can hold target_id, source_id and server, status ('read' or 'unread'), and start and end (unix timestamps).
+        clauses = []
+        parameters = []
+
+        for field in ('target_id', 'source_id', 'server'):
+            if filters.get (field):
+                clauses.append (f"{field} = ?")
+                parameters.append (str (filters[field]))
+
+        if filters.get ('status') in ('read', 'unread'):
+            clauses.append ("handled = ?")
+            parameters.append (int (filters['status'] == 'read'))
+
+        if filters.get ('start') is not None:
+            clauses.append ("timestamp >= ?")
+            parameters.append (float (filters['start']))
+        if filters.get ('end') is not None:
+            clauses.append ("timestamp <= ?")
+            parameters.append (float (filters['end']))
+
+        return (" WHERE " + " AND ".join (clauses)) if clauses else "", parameters
+
+    def get_reports (self, filters=None, page=1, page_size=50):
+        # Newest first, with the total so the caller knows how many pages there are.
+        where, parameters = ReportStore.build_filter (filters or {})
+
+        with self.lock:
+            total = self.connection.execute (f"SELECT COUNT(*) FROM reports{where}", parameters).fetchone ()[0]
+            rows = self.connection.execute (f"SELECT {', '.join (ReportStore.columns)} FROM reports{where} ORDER BY timestamp DESC, hash LIMIT ? OFFSET ?",
+                                            parameters + [page_size, (page - 1) * page_size]).fetchall ()
+
+        return [ReportStore.row_to_dict (row) for row in rows], total
+
+    def get_top_reported (self, days=7, page=1, page_size=20):
+        # The players reported most since days ago, by how many people reported them and then by reports.
+        since = time.time () - days * 24 * 60 * 60
+        query = """
+            SELECT target_id, MAX(target), COUNT(*), COUNT(DISTINCT source_id), SUM(handled = 0), MAX(timestamp)
+            FROM reports WHERE timestamp >= ?
+            GROUP BY target_id
+            ORDER BY COUNT(DISTINCT source_id) DESC, COUNT(*) DESC, MAX(timestamp) DESC
+            LIMIT ? OFFSET ?
+        """
+
+        with self.lock:
+            total = self.connection.execute ("SELECT COUNT(DISTINCT target_id) FROM reports WHERE timestamp >= ?", (since,)).fetchone ()[0]
+            rows = self.connection.execute (query, (since, page_size, (page - 1) * page_size)).fetchall ()
+
+        players = [{
+            'target_id': target_id,
+            'target': target,
+            'reports': reports,
+            'reporters': reporters,
+            'unread': unread,
+            'last_reported': last_reported
+        } for target_id, target, reports, reporters, unread, last_reported in rows]
+
+        return players, total
+
 class UserReport:
     report_directories = []
     checking_thread = None
+    handled = None
+    handled_lock = threading.Lock ()
+    # path -> ((size, mtime_ns), parsed report or None)
+    scan_cache = {}
+    scan_lock = threading.Lock ()
+    backlog_size = 64
+    backlog_workers = 4
+    detect_prefix_size = 4096
+    # Reports parsed since they were last written to the report store.
+    unarchived = []
+    # New reports waiting to be sent to the web server
+    send_queue = queue.Queue ()
+    sender_thread = None
+    sender_lock = threading.Lock ()
+    # Reports directory -> names of the servers that use it
+    directory_servers = {}
 
     def __init__ (self, target, target_id, source, source_id, date, reason, text):
         self.target = target
@@ -647,6 +2334,7 @@ class UserReport:
         self.date = date
         self.reason = reason
         self.text = text
+        self.server = ""
         self.hash = self.generate_hash()
 
     def generate_hash (self):
@@ -655,16 +2343,23 @@ class UserReport:
         return hasher.hexdigest()
     
     @staticmethod
-    def register_reports_directory (dir):
+    def register_reports_directory (dir, server=None):
+        # Absolute, so paths from the scan and from the file watcher are the same scan cache keys.
+        dir = os.path.abspath (dir)
+        # Servers sharing an install share a Reports directory, their reports are attributed to all of them.
+        if server is not None and server not in UserReport.directory_servers.setdefault (dir, []):
+            UserReport.directory_servers[dir].append (server)
         if dir not in UserReport.report_directories:
             UserReport.report_directories.append(dir)
             if not os.path.exists (dir):
                 os.makedirs (dir)
                 logging.info (f"{dir} doesn't exist. Creating..")
+            file_watcher.watch_directory (dir, UserReport.report_file_written)
 
     @staticmethod
     def remove_reports_directory (dir):
         UserReport.report_directories.remove (dir)
+        file_watcher.unwatch_directory (dir, UserReport.report_file_written)
 
     @staticmethod
     def start_report_checking_thread ():
@@ -673,6 +2368,8 @@ class UserReport:
     
     @staticmethod
     def report_checking_thread ():
+        # New reports arrive through report_file_written. This full scan catches anything the
+        # file watcher missed, and sends the whole list to a web server that reconnected.
         time.sleep (5)
         while True:
             UserReport.search_directories ()
@@ -681,50 +2378,179 @@ class UserReport:
     @staticmethod
     def search_directories():
         new_reports = []
-        for directory in UserReport.report_directories:
+        file_paths = []
+
+        for directory in list (UserReport.report_directories):
             if not os.path.isdir(directory):
                 write_to_log_error (f"Directory '{directory}' does not exist.", LogLevel.WARNING, method="UserReport.search_directories()")
                 UserReport.remove_reports_directory(directory)
                 continue
 
-            for filename in os.listdir(directory):
-                file_path = os.path.join(directory, filename)
-                if os.path.isfile(file_path):
-                    with open(file_path, 'rb') as file:
-                        raw_data = file.read()
+            with os.scandir (directory) as entries:
+                for entry in entries:
+                    if entry.is_file ():
+                        file_paths.append (entry.path)
 
-                    result = chardet.detect(raw_data)
-                    encoding = result['encoding']
+        UserReport.parse_backlog (file_paths)
 
-                    try:
-                        with open(file_path, 'r', encoding=encoding) as file:
-                            file_contents = file.read()
-                    except UnicodeDecodeError:
-                        write_to_log_error (f"Could not decode file '{file_path}'. Attempting to read with errors='replace'.", LogLevel.WARNING, method="UserReport.search_directories()")
-                        with open(file_path, 'r', encoding=encoding, errors='replace') as file:
-                            file_contents = file.read()
+        for file_path in file_paths:
+            report, changed = UserReport.get_cached_report (file_path)
 
-                    report = UserReport.parse_report(file_contents)
+            if report is not None and not UserReport.has_report_been_handled(report.hash):
+                new_reports.append(report)
 
-                    if not UserReport.has_report_been_handled(report.hash):
-                        new_reports.append(report)
+        # Forget files that were deleted, or whose directory is no longer watched.
+        seen_paths = set (file_paths)
+        with UserReport.scan_lock:
+            for file_path in list (UserReport.scan_cache):
+                if file_path not in seen_paths:
+                    del UserReport.scan_cache[file_path]
 
+        UserReport.archive_new_reports ()
         send_new_reports (new_reports)
-                
+
     @staticmethod
-    def has_report_been_handled (hash):
-        handled_path = os.path.join (data_dir, "handled_reports.txt")
+    def parse_backlog (file_paths):
+        # Many files that were never parsed, like on the first scan after downtime, are read on a few threads.
+        with UserReport.scan_lock:
+            unparsed = [file_path for file_path in file_paths if file_path not in UserReport.scan_cache]
+
+        if len (unparsed) < UserReport.backlog_size:
+            return
 
-        if not os.path.isfile(handled_path):
-            with open (handled_path, 'w') as file:
+        with concurrent.futures.ThreadPoolExecutor (max_workers=UserReport.backlog_workers) as executor:
+            for _ in executor.map (UserReport.get_cached_report, unparsed):
                 pass
-    
-        with open(handled_path, 'r') as file:
-            for line in file:
-                if line.strip() == hash:
-                    return True
-        
-        return False
+
+    @staticmethod
+    def report_file_written (file_path):
+        # From the file watcher, as soon as the game closes a report file.
+        if os.path.dirname (file_path) not in UserReport.report_directories:
+            return
+
+        report, changed = UserReport.get_cached_report (file_path)
+        UserReport.archive_new_reports ()
+        if changed and report is not None and not UserReport.has_report_been_handled (report.hash):
+            UserReport.queue_new_report (report)
+
+    @staticmethod
+    def queue_new_report (report):
+        # Sent from its own thread, the file watcher's thread must never wait on the web server.
+        with UserReport.sender_lock:
+            if UserReport.sender_thread is None:
+                UserReport.sender_thread = threading.Thread (target=UserReport.report_sending_thread, daemon=True)
+                UserReport.sender_thread.start ()
+        UserReport.send_queue.put (report)
+
+    @staticmethod
+    def report_sending_thread ():
+        while True:
+            report = UserReport.send_queue.get ()
+            try:
+                send_new_report (report)
+            except Exception as e:
+                write_to_log_error (f"Could not send report {report.hash}. {e}", LogLevel.ERROR, method="UserReport.report_sending_thread()")
+
+    @staticmethod
+    def archive_new_reports ():
+        # Everything parsed since the last call goes into the report store in one transaction.
+        with UserReport.scan_lock:
+            reports = UserReport.unarchived
+            UserReport.unarchived = []
+
+        if not reports or report_store is None:
+            return
+
+        try:
+            report_store.add_reports (reports, UserReport.get_handled_reports ().hashes)
+        except sqlite3.Error as e:
+            write_to_log_error (f"Could not archive {len (reports)} reports. {e}", LogLevel.ERROR, method="UserReport.archive_new_reports()")
+
+    @staticmethod
+    def get_cached_report (file_path):
+        # Only files that are new or changed since the last scan are read and parsed again.
+        # Returns the report, or None if it can't be read, and whether it was parsed just now.
+        try:
+            stat = os.stat (file_path)
+        except FileNotFoundError:
+            return None, False
+        key = (stat.st_size, stat.st_mtime_ns)
+
+        with UserReport.scan_lock:
+            cached = UserReport.scan_cache.get (file_path)
+        if cached is not None and cached[0] == key:
+            return cached[1], False
+
+        try:
+            report = UserReport.read_report_file (file_path)
+        except FileNotFoundError:
+            return None, False
+        except (IndexError, ValueError) as e:
+            # Kept as None so a malformed file is only reported once, until it changes.
+            write_to_log_error (f"Could not parse report '{file_path}': {e}", LogLevel.WARNING, method="UserReport.get_cached_report()")
+            report = None
+
+        if report is not None:
+            report.server = ", ".join (UserReport.directory_servers.get (os.path.dirname (file_path), []))
+
+        with UserReport.scan_lock:
+            UserReport.scan_cache[file_path] = (key, report)
+            if report is not None:
+                UserReport.unarchived.append (report)
+        return report, True
+
+    @staticmethod
+    def read_report_file (file_path):
+        with open(file_path, 'rb') as file:
+            raw_data = file.read()
+
+        return UserReport.parse_report(UserReport.decode_report (raw_data, file_path))
+
+    @staticmethod
+    def decode_report (raw_data, file_path=""):
+        # A BOM or valid UTF-8 settles the encoding. chardet only guesses from the start of anything else.
+        if raw_data.startswith (codecs.BOM_UTF8):
+            encoding = 'utf-8-sig'
+        elif raw_data.startswith ((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            encoding = 'utf-16'
+        else:
+            encoding = None
+            # UTF-16 without a BOM is full of NUL bytes, which are valid UTF-8.
+            if b'\0' not in raw_data:
+                try:
+                    return UserReport.normalize_newlines (raw_data.decode ('utf-8'))
+                except UnicodeDecodeError:
+                    pass
+
+        if encoding is None:
+            encoding = chardet.detect (raw_data[:UserReport.detect_prefix_size])['encoding'] or 'utf-8'
+
+        try:
+            file_contents = raw_data.decode (encoding)
+        except (UnicodeDecodeError, LookupError):
+            write_to_log_error (f"Could not decode file '{file_path}'. Attempting to read with errors='replace'.", LogLevel.WARNING, method="UserReport.decode_report()")
+            try:
+                file_contents = raw_data.decode (encoding, errors='replace')
+            except LookupError:
+                file_contents = raw_data.decode ('utf-8', errors='replace')
+
+        return UserReport.normalize_newlines (file_contents)
+
+    @staticmethod
+    def normalize_newlines (text):
+        # The same as reading the file in text mode, so the fields and hashes don't change.
+        return text.replace ('\r\n', '\n').replace ('\r', '\n')
+
+    @staticmethod
+    def get_handled_reports ():
+        with UserReport.handled_lock:
+            if UserReport.handled is None:
+                UserReport.handled = HandledReports (os.path.join (data_dir, "handled_reports.txt"))
+            return UserReport.handled
+
+    @staticmethod
+    def has_report_been_handled (hash):
+        return hash in UserReport.get_handled_reports ()
 
     @staticmethod
     def parse_report(file_contents):
@@ -743,15 +2569,58 @@ class UserReport:
 
     @staticmethod
     def handle_report (hash):
-        handled_path = os.path.join (data_dir, "handled_reports.txt")
+        UserReport.get_handled_reports ().add (hash)
+        if report_store is not None:
+            report_store.set_handled (hash, True)
+
+    @staticmethod
+    def unhandle_report (hash):
+        UserReport.get_handled_reports ().remove (hash)
+        if report_store is not None:
+            report_store.set_handled (hash, False)
+
+        # Back in the web server's new reports, if the game's file is still there.
+        for report in UserReport.get_scanned_reports (hash).values ():
+            UserReport.queue_new_report (report)
+            break
 
-        with open (handled_path, 'a') as file:
-            file.write (hash + '\n')
+    @staticmethod
+    def get_scanned_reports (hash):
+        with UserReport.scan_lock:
+            return {file_path: report for file_path, (key, report) in UserReport.scan_cache.items () if report is not None and report.hash == hash}
 
     @staticmethod 
     def delete_report (hash):
-        raise NotImplementedError
+        # Removes the game's report file and the archived copy. Also marked handled, so a copy of the file
+        # that couldn't be removed doesn't show up as new again.
+        for file_path in UserReport.get_scanned_reports (hash):
+            try:
+                os.remove (file_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                write_to_log_error (f"Could not delete report file '{file_path}'. {e}", LogLevel.WARNING, method="UserReport.delete_report()")
+                continue
+            with UserReport.scan_lock:
+                UserReport.scan_cache.pop (file_path, None)
+
+        UserReport.get_handled_reports ().add (hash)
+        if report_store is not None:
+            report_store.delete (hash)
     
+    def to_dict (self):
+        return {
+            'target': self.target,
+            'target_id': self.target_id,
+            'source': self.source,
+            'source_id': self.source_id,
+            'date': self.date,
+            'reason': self.reason,
+            'text': self.text,
+            'server': self.server,
+            'hash': self.hash
+        }
+
     def __str__ (self):
         return f"Report(server={self.server}, target={self.target}, target_id={self.target_id}, source={self.source}, source_id={self.source_id}, date={self.date}, reason={self.reason}, text={self.text}, hash={self.hash})"
     
@@ -762,6 +2631,21 @@ class UserReport:
 
 servers = []
 server_info = []
+log_event_matcher = LogEventMatcher()
+file_watcher = FileWatcher()
+server_info_publisher = ServerInfoPublisher()
+replay_transcript = None
+event_store = None
+report_store = None
+log_writer = LogWriter()
+log_archive = None
+log_file_started = None
+log_rotate_size = 10 * 1024 * 1024
+log_rotate_age = 7 * 24 * 60 * 60
+control_connections = []
+ipc_transport = 'tcp'
+local_event_handlers = []
+max_frame_size = 64 * 1024 * 1024
 main_log_file = None
 is_using_web_server = False
 web_server_online = False
@@ -771,81 +2655,85 @@ web_server_address = None
 web_server_port = None
 
 def register_player_join (server, player, player_name):
-    write_to_log (server, f"Player {player_name} [{player}] connected.")
+    write_to_log (server, f"Player {player_name} [{player}] connected.", "player_join", {"player": player, "player_name": player_name})
     send_server_info ()
 
 def register_player_leave (server, player, player_name):
-    write_to_log (server, f"Player {player_name} [{player}] has disconnected.")
+    write_to_log (server, f"Player {player_name} [{player}] has disconnected.", "player_leave", {"player": player, "player_name": player_name})
     send_server_info ()
 
 def register_server_restart (server, reason):
-    write_to_log (server, f"Server restarted for: {reason}.")
+    write_to_log (server, f"Server restarted for: {reason}.", "server_restart", {"reason": reason})
     send_server_info ()
     
 def register_server_start (server):
-    write_to_log (server, f"Server started.")
+    write_to_log (server, f"Server started.", "server_start")
     send_server_info ()
 
 def register_server_active (server):
-    write_to_log (server, f"Server active.")
+    write_to_log (server, f"Server active.", "server_active")
     send_server_info ()
 
 def register_server_stop (server):
-    write_to_log (server, f"Server stopped.")
+    write_to_log (server, f"Server stopped.", "server_stop")
     send_server_info ()
 
 def register_server_offline (server):
-    write_to_log (server, f"Server offline.")
+    write_to_log (server, f"Server offline.", "server_offline")
     send_server_info ()
 
 def register_server_suspend (server):
-    write_to_log (server, "Server suspended.")
+    write_to_log (server, "Server suspended.", "server_suspend")
     send_server_info ()
 
 def register_server_wake (server):
-    write_to_log (server, "Server waking from suspension.")
+    write_to_log (server, "Server waking from suspension.", "server_wake")
     send_server_info ()
 
 def register_server_idle (server):
-    write_to_log (server, "Server is now idle.")
+    write_to_log (server, "Server is now idle.", "server_idle")
+    send_server_info ()
+
+def register_server_resumed (server):
+    write_to_log (server, "Re-attached to running server.", "server_resumed")
     send_server_info ()
 
 def register_server_creating (server):
-    write_to_log (server, "Server is being created for the first time.")
+    write_to_log (server, "Server is being created for the first time.", "server_creating")
     send_server_info()
 
 def register_server_created (server):
-    write_to_log (server, "Server successfully created.")
+    write_to_log (server, "Server successfully created.", "server_created")
 
 def register_game_change (server, game):
-    write_to_log (server, f"Game changed to {game}.")
+    write_to_log (server, f"Game changed to {game}.", "game_change", {"game": game})
 
 def register_checkpoint (server, checkpoint):
-    write_to_log (server, f"Activated checkpoint {checkpoint}.")
+    write_to_log (server, f"Activated checkpoint {checkpoint}.", "checkpoint", {"checkpoint": checkpoint})
 
 def register_objective_completed (server, objective):
-    write_to_log (server, f"Completed objective {objective}.")
+    write_to_log (server, f"Completed objective {objective}.", "objective_completed", {"objective": objective})
 
 def register_player_died (server):
-    write_to_log (server, f"Player died.")
+    write_to_log (server, f"Player died.", "player_died")
 
 def register_game_ended (server):
-    write_to_log (server, "Game ended.")
+    write_to_log (server, "Game ended.", "game_ended")
 
 def register_game_started (server):
-    write_to_log (server, "Game started.")
+    write_to_log (server, "Game started.", "game_started")
 
 def register_game_loading (server, game):
-    write_to_log (server, f"Loading {game}.")
+    write_to_log (server, f"Loading {game}.", "game_loading", {"game": game})
 
 def register_gamemode_loading (server, gamemode):
-    write_to_log (server, f"Gamemode: {gamemode}.")
+    write_to_log (server, f"Gamemode: {gamemode}.", "gamemode_loading", {"gamemode": gamemode})
 
 def register_session_created (server):
-    write_to_log (server, "Session created. Now idling.")
+    write_to_log (server, "Session created. Now idling.", "session_created")
 
 def register_server_empty (server):
-    write_to_log (server, "Server empty.")
+    write_to_log (server, "Server empty.", "server_empty")
 
 def log_is_objective_completed (line):
     match = re.search(r'LogObjectives: Completed Objective (.*?) successfully', line)
@@ -948,95 +2836,143 @@ def execute_server_kill (server):
     get_server_from_name (server).execute_server_kill ()
 
 
+def get_server_info_snapshot ():
+    # The analysis threads keep updating ServerInfo, retry a copy that raced with one of them.
+    snapshot = {}
+    for info in list (server_info):
+        while True:
+            try:
+                snapshot[info.name] = info.to_dict ()
+                break
+            except RuntimeError:
+                continue
+
+    return snapshot
+
 def send_server_info ():
-    global server_info, web_server_port, web_server_address
-    
-    # Check web server status, return if offline, not found or not used.
-    if not check_web_server():
-        write_to_log_error ("Failed to ping web server", method="send_server_info()")
+    if replay_transcript is not None:
+        return
+
+    server_info_publisher.mark_dirty ()
+
+def publish_server_info ():
+    global server_info, web_server_port, web_server_address, web_server_online
+
+    if ipc_transport == 'embedded':
+        publish_server_info_as_event ()
+        return
+
+    # Not used, or offline. The waiting thread marks the state dirty again once it is back.
+    if not is_using_web_server:
+        return
+    if ipc_transport == 'unix':
+        publish_server_info_as_event ()
+        return
+    if not web_server_online:
+        start_wait_for_web_server_thread()
         return
     
-    server_info_dicts = [
-        {
-            "server_name": info.name,
-            "current_game": info.current_game,
-            "current_gamemode": info.current_gamemode,
-            "current_checkpoint": info.current_checkpoint,
-            "last_completed_objective": info.last_completed_objective,
-            "previous_game": info.previous_game,
-            "joined_users": list(info.joined_users),
-            "disconnected_users": list(info.disconnected_users),
-            "current_users": info.current_users,
-            "gamemode_changes": info.gamemode_changes,
-            "total_user_joins": info.total_user_joins,
-            "total_user_disconnects": info.total_user_disconnects,
-            "server_restarts": info.server_restarts,
-            "player_deaths": info.player_deaths,
-            "game_attempts": info.game_attempts,
-            "server_status": info.server_status
-        }
-        for info in server_info
-    ]
-    config = read_global_config()
-    json_data = json.dumps (server_info_dicts)
+    update, current = server_info_publisher.build_update (get_server_info_snapshot())
+    if update is None:
+        return
+
     url = (f"http://{web_server_address}:{web_server_port}/update_server_info")
     try:
-        json_string = {"server_info": json_data}
-        response = requests.post(url, json=json_string)
-    except requests.exceptions.ConnectionError as e:
-        if check_web_server():
-            write_to_log_error (f"Unknown Web Server Error. {e}", method="send_server_info()")
-            return
-        else:
-            write_to_log_error (f"Web server either crashed or lost connection. Attempting to reconnect.", method="send_server_info()")
-            return
-    except requests.exceptions.Timeout as e:
-        if check_web_server():
-            write_to_log_error (f"Unknown Web Server Error. {e}", method="send_server_info()")
-            return
-        else:
-            write_to_log_error (f"Web server either crashed or lost connection. Attempting to reconnect.", method="send_server_info()")
-            return
+        response = requests.post(url, json=update, timeout=10)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        write_to_log_error (f"Web server either crashed or lost connection. Attempting to reconnect. {e}", method="publish_server_info()")
+        web_server_online = False
+        server_info_publisher.full_sync = True
+        start_wait_for_web_server_thread()
+        return
+
+    # The web server missed an update, most likely it restarted. Send everything again.
+    if response.status_code == 409:
+        server_info_publisher.request_full_sync ()
+    elif response.status_code // 100 == 2:
+        server_info_publisher.commit_update (update, current)
+    else:
+        write_to_log_error (f"Web server rejected server info update: {response.status_code}", method="publish_server_info()")
+        server_info_publisher.request_full_sync ()
+
+def publish_server_info_as_event ():
+    # Nobody to send to. The web server gets a full update when it connects.
+    if not control_connections and not local_event_handlers:
+        server_info_publisher.full_sync = True
+        return
+
+    update, current = server_info_publisher.build_update (get_server_info_snapshot())
+    if update is None:
+        return
+
+    if push_to_web ("server_info", update):
+        server_info_publisher.commit_update (update, current)
+    else:
+        server_info_publisher.full_sync = True
+
+def push_to_web (event, data):
+    if ipc_transport == 'embedded':
+        for handler in local_event_handlers:
+            handler (event, data)
+        return bool (local_event_handlers)
+
+    # Sent without waiting for an answer. If the web server misses one it asks for a resync.
+    sent = False
+    for connection in list (control_connections):
+        try:
+            connection.send ({"event": event, "data": data})
+            sent = True
+        except OSError as e:
+            write_to_log_error (f"Could not push {event} to {connection.address}: {e}", LogLevel.WARNING, method="push_to_web()")
+
+    return sent
 
 def send_new_reports (reports):
     global server_info, web_server_port, web_server_address
+
+    if ipc_transport in ('unix', 'embedded'):
+        push_to_web ("new_reports", [report.to_dict() for report in reports])
+        return
     
     # Check web server status, return if offline, not found or not used.
     if not check_web_server():
         write_to_log_error ("Failed to ping web server", method="send_new_reports()")
         return
     
-    report_dict = [
-        {
-            'target': report.target,
-            'target_id': report.target_id,
-            'source': report.source,
-            'source_id': report.source_id,
-            'date': report.date,
-            'reason': report.reason,
-            'text': report.text,
-            'hash': report.hash
-        }
-        for report in reports
-    ]
+    report_dict = [report.to_dict() for report in reports]
    
     json_data = json.dumps (report_dict)
-    url = (f"http://{web_server_address}:{web_server_port}/receive_new_reports")
+    post_reports_to_web ("receive_new_reports", json_data, "send_new_reports()")
+
+def send_new_report (report):
+    # One report, added to the ones the web server already has instead of replacing them.
+    if ipc_transport in ('unix', 'embedded'):
+        push_to_web ("new_report", report.to_dict())
+        return
+
+    if not check_web_server():
+        write_to_log_error ("Failed to ping web server", method="send_new_report()")
+        return
+
+    post_reports_to_web ("receive_new_report", json.dumps (report.to_dict()), "send_new_report()")
+
+def post_reports_to_web (route, json_data, method):
+    url = (f"http://{web_server_address}:{web_server_port}/{route}")
     try:
-        response = requests.post(url, json=json_data)
+        response = requests.post(url, json=json_data, timeout=10)
     except requests.exceptions.ConnectionError as e:
         if check_web_server():
-            write_to_log_error (f"Unknown Web Server Error. {e}", method="send_new_reports()")
+            write_to_log_error (f"Unknown Web Server Error. {e}", method=method)
             return
         else:
-            write_to_log_error (f"Web server either crashed or lost connection. Attempting to reconnect.", method="send_new_reports()")
+            write_to_log_error (f"Web server either crashed or lost connection. Attempting to reconnect.", method=method)
             return
     except requests.exceptions.Timeout as e:
         if check_web_server():
-            write_to_log_error (f"Unknown Web Server Error. {e}", method="send_new_reports()")
+            write_to_log_error (f"Unknown Web Server Error. {e}", method=method)
             return
         else:
-            write_to_log_error (f"Web server either crashed or lost connection. Attempting to reconnect.", method="send_new_reports()")
+            write_to_log_error (f"Web server either crashed or lost connection. Attempting to reconnect.", method=method)
             return
 
 def begin_server (name):
@@ -1047,6 +2983,7 @@ def begin_server (name):
     servers.append (server_instance)
     server_info.append (server_info_instance)
     server_instance.init_server()
+    server_instance.resume_from_checkpoint()
 
 def create_server (formdata):
     global server_info, servers, data_dir
@@ -1117,6 +3054,7 @@ def create_server (formdata):
         return e
     
     register_server_created (server_name)
+    push_to_web ("server_created", {"server_name": server_name})
     time.sleep (1)
     server_instance.init_server()
 
@@ -1162,6 +3100,7 @@ def update_server_path_name (server):
             write_to_log_error (e, method="update_server_path_name()")
 
         server_instance.update_server_path_name (server_new_name)
+        push_to_web ("server_renamed", {"old_name": server, "new_name": server_new_name})
 
 
 def add_to_global_ban_list (user_id):
@@ -1214,7 +3153,7 @@ def ping_web_server ():
         return False
 
     try:
-        response = requests.get(f"http://{web_server_address}:{web_server_port}")
+        response = requests.get(f"http://{web_server_address}:{web_server_port}", timeout=10)
         if response.status_code // 100 == 2:
             return True
         else:
@@ -1233,35 +3172,35 @@ def wait_for_web_server ():
         if ping_web_server():
             web_server_online = True
             wait_for_web_server_thread = None
+            send_server_info ()
+            break
         time.sleep (5)
 
 def start_wait_for_web_server_thread():
     global wait_for_web_server_thread
     if wait_for_web_server_thread == None:
-        wait_for_web_server_thread = threading.Thread(target=wait_for_web_server, daemon=True).start()
+        wait_for_web_server_thread = threading.Thread(target=wait_for_web_server, daemon=True)
+        wait_for_web_server_thread.start()
 
 
-def write_to_log (server, content):
-    global log_dir
+def write_to_log (server, content, event_type="log", data=None):
+    if replay_transcript is not None:
+        replay_transcript.append (f"{server} - {content}")
+        return
 
-    logging.info (f"{server} - {content}")
+    logging.info ("%s - %s", server, content)
 
-    log_file = os.path.join (log_dir, "log.txt")
+    timestamp = time.time ()
+    formatted_datetime = datetime.fromtimestamp (timestamp).strftime("%d-%m-%Y %Hh%M")
 
-    current_datetime = datetime.now()
-    formatted_datetime = current_datetime.strftime("%d-%m-%Y %Hh%M")
-    with open(log_file, 'a') as log:
-        log.write(f"\n[{formatted_datetime}] {server} - {content}")
+    line = f"\n[{formatted_datetime}] {server} - {content}"
+    event = (timestamp, server, LogLevel.INFO.name, event_type, "", str (content), json.dumps (data) if data is not None else None)
+    log_writer.write (line, event)
 
 def write_to_log_error (content, severity: LogLevel=LogLevel.WARNING, server="", method=""):
-    global log_dir 
-
-    console_error_string = ""
-    if server != "":
-        console_error_string += f" {server}"
-    if method != "":
-        console_error_string += f" {method}"
-    console_error_string += f" - {content}"
+    if replay_transcript is not None:
+        replay_transcript.append (f"[{severity.name}] {server} ({method}) - {content}")
+        return
 
     match severity:
         case LogLevel.DEBUG:
@@ -1275,10 +3214,8 @@ def write_to_log_error (content, severity: LogLevel=LogLevel.WARNING, server="",
         case LogLevel.CRITICAL:
             logging.critical (content)
 
-    log_file = os.path.join (log_dir, "log.txt")
-
-    current_datetime = datetime.now()
-    formatted_datetime = current_datetime.strftime("%d-%m-%Y %Hh%M")
+    timestamp = time.time ()
+    formatted_datetime = datetime.fromtimestamp (timestamp).strftime("%d-%m-%Y %Hh%M")
 
     error_string = f"\n[{formatted_datetime}] [{severity.name}]"
     if server != "":
@@ -1286,14 +3223,51 @@ def write_to_log_error (content, severity: LogLevel=LogLevel.WARNING, server="",
     if method != "":
         error_string += f" ({method})"
     error_string += f" - {content}"
-    
 
-    with open(log_file, 'a') as log:
-        log.write(error_string)
+    event = (timestamp, server, severity.name, "error", method, str (content), None)
+    log_writer.write (error_string, event)
 
-def create_log_file():
+def open_event_store ():
+    global event_store, log_dir
+
+    try:
+        event_store = EventStore (os.path.join (log_dir, EventStore.file_name))
+    except sqlite3.Error as e:
+        event_store = None
+        write_to_log_error (f"Could not open the event store, events are only written to log.txt. {e}", LogLevel.ERROR, method="open_event_store()")
+
+def open_report_store ():
+    global report_store, data_dir
+
+    try:
+        report_store = ReportStore (os.path.join (data_dir, ReportStore.file_name))
+    except sqlite3.Error as e:
+        report_store = None
+        write_to_log_error (f"Could not open the report store, reports are not archived. {e}", LogLevel.ERROR, method="open_report_store()")
+
+def import_old_logs ():
     global log_dir
 
+    try:
+        log_archive.compress_pending ()
+    except OSError as e:
+        write_to_log_error (f"Compressing old log files failed. {e}", LogLevel.ERROR, method="import_old_logs()")
+
+    if event_store is None:
+        return
+
+    try:
+        imported = event_store.import_log_directory (log_dir)
+        if imported:
+            write_to_log ("Manager", f"Imported {imported} events from old log files.")
+    except (sqlite3.Error, OSError) as e:
+        write_to_log_error (f"Importing old log files failed. {e}", LogLevel.ERROR, method="import_old_logs()")
+
+def create_log_file():
+    global log_dir, log_file_started
+
+    log_file_started = time.time()
+
     log_file = os.path.join (log_dir, "log.txt")
     current_datetime = datetime.now()
     formatted_datetime = current_datetime.strftime("%d-%m-%Y %Hh%M")
@@ -1301,10 +3275,17 @@ def create_log_file():
         with open(log_file, 'w') as log:
             log.write(f"[Start of log file: {formatted_datetime}]\n")
     else:
-        save_log_file()
+        archive = save_log_file()
         with open(log_file, 'w') as log:
             log.write(f"[Start of log file: {formatted_datetime}]\n")
 
+        # Compressing a large log shouldn't hold up logging.
+        threading.Thread (target=log_archive.compress, args=(archive,), daemon=True).start ()
+
+    # From here on everything in log.txt is also in the event store.
+    if event_store is not None:
+        event_store.mark_imported ("log.txt")
+
 def save_log_file():
     global log_dir
 
@@ -1314,11 +3295,36 @@ def save_log_file():
     log_file = os.path.join (log_dir, "log.txt")
     log_save_log = os.path.join (log_dir, f"log_{formatted_datetime}.txt")
 
+    # Rotating by size can happen more than once a minute.
+    suffix = 1
+    while os.path.exists (log_save_log) or os.path.exists (log_save_log + ".gz"):
+        log_save_log = os.path.join (log_dir, f"log_{formatted_datetime}_{suffix}.txt")
+        suffix += 1
+
     shutil.move(log_file, log_save_log)
 
+    if event_store is not None:
+        event_store.archive_mirrored_log (os.path.basename (log_save_log))
+
     with open(log_file, 'w') as log:
         log.write("")
 
+    return log_save_log
+
+def rotate_log_file_if_due ():
+    global log_dir
+
+    if log_file_started is None:
+        return
+
+    try:
+        size = os.path.getsize (os.path.join (log_dir, "log.txt"))
+    except OSError:
+        return
+
+    if size >= log_rotate_size or time.time() - log_file_started >= log_rotate_age:
+        create_log_file()
+
 def read_config(config_file_path):
     if not os.path.isfile (config_file_path):
         generate_config (config_file_path)
@@ -1391,18 +3397,25 @@ def read_global_config ():
     return config
     
 def generate_global_config ():
-    global config_dir
-
-    config_file = os.path.join (config_dir, "config.ini")
+    # Also called from the web server, which never sets config_dir.
+    config_file = os.path.join (platformdirs.user_config_dir ("Meshed Server Tool", "Skomesh", ensure_exists=True), "config.ini")
 
     new_config = configparser.ConfigParser()
     new_config['WebServer'] = {
         'web_server_enabled': True,
         'web_server_address': '127.0.0.1',
-        'web_server_port': 5000
+        'web_server_port': 5000,
+        'ipc_transport': 'tcp',
+        'ipc_socket_path': '',
+        'embedded_manager': False,
+        'web_server_mode': 'async',
+        'max_stream_connections': 2000
     }
     new_config['General'] = {
-        'log_checking_interval': 4
+        'log_checking_interval': 4,
+        'checkpoint_interval': 30,
+        'log_rotate_size_mb': 10,
+        'log_rotate_days': 7
     }
     new_config['MOTD'] = {
         'global_server_motd': ''
@@ -1411,72 +3424,243 @@ def generate_global_config ():
         new_config.write (config)
 
 
+def send_frame (sock, message):
+    # Every message is a 4 byte big endian length followed by that many bytes of JSON.
+    data = json.dumps (message).encode ('utf-8')
+    sock.sendall (struct.pack ('>I', len (data)) + data)
+
+def recv_exactly (sock, size):
+    data = b""
+    while len (data) < size:
+        chunk = sock.recv (size - len (data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_frame (sock):
+    header = recv_exactly (sock, 4)
+    if header is None:
+        return None
+
+    length = struct.unpack ('>I', header)[0]
+    if length > max_frame_size:
+        raise ValueError (f"Frame of {length} bytes is larger than {max_frame_size}")
+
+    data = recv_exactly (sock, length)
+    if data is None:
+        return None
+
+    return json.loads (data)
+
+class ControlConnection:
+    def __init__ (self, client_socket, client_address):
+        self.socket = client_socket
+        self.address = client_address
+        self.write_lock = threading.Lock ()
+
+    def send (self, message):
+        with self.write_lock:
+            send_frame (self.socket, message)
+
+def get_control_address (config, connect=False):
+    transport = config['WebServer'].get ('ipc_transport', 'tcp')
+
+    if transport == 'unix' and hasattr (socket, 'AF_UNIX'):
+        path = config['WebServer'].get ('ipc_socket_path', '')
+        if not path:
+            path = os.path.join (platformdirs.user_data_dir ("Meshed Server Tool", "Skomesh"), "manager.sock")
+        return socket.AF_UNIX, path
+
+    address = '127.0.0.1' if connect else config['WebServer']['web_server_address']
+    return socket.AF_INET, (address, int (config['WebServer']['web_server_port']) + 1)
+
 def init_sockets ():
-    global web_server_address, web_server_port
+    global ipc_transport
 
-    server_socket = socket.socket (socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind ((web_server_address, int (web_server_port) + 1))
-    server_socket.listen(2)
+    family, address = get_control_address (read_global_config())
+    server_socket = socket.socket (family, socket.SOCK_STREAM)
 
-    threading.Thread(target=listen_for_clients, args=(server_socket,)).start()
+    if family == socket.AF_INET:
+        ipc_transport = 'tcp'
+        server_socket.setsockopt (socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind (address)
+    else:
+        ipc_transport = 'unix'
+
+        # Left behind if the manager didn't shut down cleanly.
+        if os.path.exists (address):
+            os.remove (address)
+
+        # Only the user running the manager may connect. Nothing can connect before listen(),
+        # so the permissions are in place first. The umask is process wide and not touched.
+        server_socket.bind (address)
+        os.chmod (address, 0o600)
+
+    server_socket.listen(8)
+
+    threading.Thread(target=listen_for_clients, args=(server_socket,), daemon=True).start()
 
 def listen_for_clients(server_socket): 
     while True:
         client_socket, client_address = server_socket.accept()
-        threading.Thread (target=handle_client, args=(client_socket, client_address)).start()
-        time.sleep (3)
+        threading.Thread (target=handle_client, args=(client_socket, client_address), daemon=True).start()
         
 def handle_client (client_socket, client_address):
+    # One persistent connection per web server, requests on it are handled concurrently.
+    connection = ControlConnection (client_socket, client_address)
+    control_connections.append (connection)
+
+    if ipc_transport == 'unix':
+        server_info_publisher.request_full_sync ()
+
     try:
-        buffer_size = 1024
-        data = b""
-        client_socket.settimeout (2)
         while True:
-            try:
-                chunk = client_socket.recv(buffer_size)
-                if not chunk:
-                    break
-                data += chunk
-            except socket.timeout:
+            request_data = recv_frame (client_socket)
+            if request_data is None:
                 break
-        
-        request_data = json.loads (data)
-
-        data_server = request_data['server']
-        data_action = request_data['action']
-
-        if data_action == "start":
-            execute_server_start (data_server)
-        elif data_action == "restart":
-            execute_server_restart (data_server)
-        elif data_action == "stop":
-            execute_server_stop (data_server)
-        elif data_action == "kill":
-            execute_server_kill (data_server)
-        elif data_action == "get_server_config":
-            server = get_server_from_name (data_server)
-            config = server.config_path
-            response = json.dumps (config)
-            client_socket.sendall (response.encode('utf-8'))
-        elif data_action == "create":
-            formdata = request_data['formdata']
-            create_server(formdata)
-        elif data_action == "read_report":
-            report_hash = request_data['hash']
-            UserReport.handle_report (report_hash)
-        elif data_action == "delete_report":
-            report_hash = request_data['hash']
-            UserReport.delete_report (report_hash)
-        elif data_action == "ban":
-            user_id = request_data['user_id']
-            add_to_global_ban_list (user_id)
-    except Exception as e:
-        write_to_log_error (f"Error handling client {client_address}: {e}, {traceback.format_exc()}", LogLevel.ERROR, method="handle_client()")
+
+            threading.Thread (target=handle_control_request, args=(connection, request_data), daemon=True).start()
+    except (OSError, ValueError) as e:
+        write_to_log_error (f"Control connection {client_address} closed: {e}", LogLevel.WARNING, method="handle_client()")
     finally:
+        control_connections.remove (connection)
         client_socket.close()
 
-def main():
-    global data_dir, config_dir, log_dir
+def handle_control_request (connection, request_data):
+    response = run_control_request (request_data, connection.address)
+
+    try:
+        connection.send (response)
+    except OSError as e:
+        write_to_log_error (f"Could not respond to {connection.address}: {e}", LogLevel.WARNING, method="handle_control_request()")
+
+def run_control_request (request_data, client_address="embedded"):
+    response = {"id": request_data.get ('id')}
+
+    try:
+        response['response'] = execute_control_request (request_data)
+        response['status'] = 200
+        response['message'] = "Success"
+    except Exception as e:
+        write_to_log_error (f"Error handling request from {client_address}: {e}, {traceback.format_exc()}", LogLevel.ERROR, method="run_control_request()")
+        response['status'] = 500
+        response['message'] = f"Error: {e}"
+
+    return response
+
+def execute_control_request (request_data):
+    data_server = request_data['server']
+    data_action = request_data['action']
+
+    if data_action == "start":
+        execute_server_start (data_server)
+    elif data_action == "restart":
+        execute_server_restart (data_server)
+    elif data_action == "stop":
+        execute_server_stop (data_server)
+    elif data_action == "kill":
+        execute_server_kill (data_server)
+    elif data_action == "get_server_config":
+        server = get_server_from_name (data_server)
+        return server.config_path
+    elif data_action == "create":
+        formdata = request_data['formdata']
+        result = create_server(formdata)
+        if result is not True:
+            raise RuntimeError (f"Could not create server. {result}")
+    elif data_action == "read_report":
+        report_hash = request_data['hash']
+        UserReport.handle_report (report_hash)
+    elif data_action == "delete_report":
+        report_hash = request_data['hash']
+        UserReport.delete_report (report_hash)
+    elif data_action == "unread_report":
+        report_hash = request_data['hash']
+        UserReport.unhandle_report (report_hash)
+    elif data_action == "ban":
+        user_id = request_data['user_id']
+        add_to_global_ban_list (user_id)
+    elif data_action == "resync":
+        server_info_publisher.request_full_sync ()
+    else:
+        raise ValueError (f"Unknown action {data_action}")
+
+    return None
+
+def replay_log (log_file_path, name="Replay", max_reloads=7, restricted_gamemode=''):
+    global replay_transcript
+
+    info = ServerInfo (name)
+    server = ReplayServer (name, info, max_reloads, restricted_gamemode)
+    server.log = LogTailer (log_file_path)
+
+    transitions = []
+    line_costs = []
+    line_count = 0
+    event_count = 0
+
+    replay_transcript = []
+    try:
+        start = time.perf_counter()
+        for line in server.log.read_lines ():
+            line_start = time.perf_counter_ns()
+            line_count += 1
+
+            event = log_event_matcher.match (line)
+            if event is not None:
+                event_count += 1
+                status = info.server_status
+                server.handle_log_event (event)
+
+                transitions.append ({
+                    "line": line_count,
+                    "event": event.type.name,
+                    "value": event.value,
+                    "previous_status": status,
+                    "server_status": info.server_status,
+                    "messages": replay_transcript
+                })
+                replay_transcript = []
+
+            line_costs.append (time.perf_counter_ns() - line_start)
+        elapsed = time.perf_counter() - start
+    finally:
+        replay_transcript = None
+
+    line_costs.sort()
+
+    return {
+        "transitions": transitions,
+        "actions": server.actions,
+        "server_info": info.to_snapshot(),
+        "lines": line_count,
+        "events": event_count,
+        "seconds": elapsed,
+        "lines_per_second": line_count / elapsed if elapsed else 0,
+        "events_per_second": event_count / elapsed if elapsed else 0,
+        "p50_ns": line_costs[len (line_costs) // 2] if line_costs else 0,
+        "p99_ns": line_costs[min (len (line_costs) - 1, len (line_costs) * 99 // 100)] if line_costs else 0
+    }
+
+def print_replay (result):
+    for transition in result['transitions']:
+        print (f"{transition['line']:>8}  {transition['event']:<20} {transition['previous_status']} -> {transition['server_status']}")
+        for message in transition['messages']:
+            print (f"{'':>10}{message}")
+
+    for action in result['actions']:
+        print (f"Action: {action}")
+
+    info = result['server_info']
+    print (f"Final state: {info['server_status']}, game {info['current_game']} ({info['current_gamemode']}), "
+           f"{len (info['current_users'])} players online, {info['total_user_joins']} joins, {info['total_user_disconnects']} disconnects")
+    print (f"{result['lines']} lines, {result['events']} events in {result['seconds']:.3f}s")
+    print (f"{result['lines_per_second']:,.0f} lines/sec, {result['events_per_second']:,.0f} events/sec")
+    print (f"Per line: p50 {result['p50_ns'] / 1000:.2f}us, p99 {result['p99_ns'] / 1000:.2f}us")
+
+def start_manager (embedded=False):
+    global data_dir, config_dir, log_dir, ipc_transport, log_archive, log_rotate_size, log_rotate_age
 
     app_name = "Meshed Server Tool"
     app_author = "Skomesh"
@@ -1487,14 +3671,28 @@ def main():
 
     configs = get_all_server_paths()
     
+    log_archive = LogArchive (log_dir)
+    general_config = get_global_config()['General']
+    log_rotate_size = float (general_config.get ('log_rotate_size_mb', 10)) * 1024 * 1024
+    log_rotate_age = float (general_config.get ('log_rotate_days', 7)) * 24 * 60 * 60
+
+    open_event_store()
+    open_report_store()
     create_log_file()
 
+    log_writer.start()
+    atexit.register (log_writer.stop)
+
+    threading.Thread (target=import_old_logs, daemon=True).start ()
+
     for config in configs:
         folder_split = config['folder'].split ('_')
         name = folder_split[1]
         begin_server (name)
     
     global_config = read_global_config()
+
+    file_watcher.start()
     
     UserReport.start_report_checking_thread()
 
@@ -1502,17 +3700,37 @@ def main():
     global is_using_web_server
 
     is_using_web_server = ast.literal_eval(global_config['WebServer']['web_server_enabled'])
-    if is_using_web_server:
-        if ping_web_server():
-            web_server_online = True
-            init_sockets()
-        else:
-            start_wait_for_web_server_thread()
+    if embedded:
+        # Running inside the web server, updates go straight to local_event_handlers.
+        ipc_transport = 'embedded'
+    elif is_using_web_server:
+        init_sockets()
+
+        # Over a unix socket the web server connects to the manager, there is nothing to ping.
+        if ipc_transport == 'tcp':
+            if ping_web_server():
+                web_server_online = True
+            else:
+                start_wait_for_web_server_thread()
     
+    server_info_publisher.start()
     send_server_info()
 
+def main():
+    # Exit normally on SIGTERM too, so the log writer gets to flush.
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (0))
+
+    start_manager()
+
     while True:
         time.sleep(3)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser (description="Meshed Server Tool server manager")
+    parser.add_argument ("--replay", metavar="LOG", help="Replay a recorded Pandemic.log without launching any servers and print the result")
+    args = parser.parse_args ()
+
+    if args.replay:
+        print_replay (replay_log (args.replay))
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,492 @@
+import asyncio
+import collections
+import concurrent.futures
+import io
+import json
+import sys
+import threading
+import time
+from urllib.parse import unquote_to_bytes
+
+class BadRequest (Exception):
+    def __init__ (self, status, message):
+        super ().__init__ (message)
+        self.status = status
+        self.message = message
+
+class StreamBroker:
+    # One payload per topic, built once per change and shared by every subscriber as encoded bytes.
+    # The last few are kept so a client that reconnects with Last-Event-ID gets what it missed.
+    backlog_size = 64
+    retry_interval = 2000
+    # How long a topic keeps its backlog, and keeps being built, after its last subscriber leaves.
+    # Long enough for a dropped connection to come back with Last-Event-ID.
+    idle_grace = 60
+
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.build_lock = threading.Lock ()
+        self.builders = {}
+        # prefix -> function making the builder for a topic that starts with it, for topics like one per server.
+        # Their builders only exist while someone is subscribed.
+        self.factories = {}
+        self.versions = {}
+        self.backlogs = {}
+        self.subscribers = {}
+        # topic -> when its last subscriber left
+        self.idle_since = {}
+
+        # Versions start over when the web server restarts, ids from an earlier run must not match.
+        self.epoch = format (int (time.time ()), 'x')
+
+    def register (self, topic, builder):
+        with self.lock:
+            self.builders.setdefault (topic, builder)
+
+    def register_factory (self, prefix, factory):
+        with self.lock:
+            self.factories[prefix] = factory
+
+    def get_builder (self, topic):
+        # Must be called with the lock held.
+        builder = self.builders.get (topic)
+        if builder is not None:
+            return builder
+
+        for prefix, factory in self.factories.items():
+            if topic.startswith (prefix):
+                # None for a topic nobody is subscribed to, so a stream that just closed can't leave one behind.
+                if not self.subscribers.get (topic) and topic not in self.idle_since:
+                    return None
+                builder = self.builders[topic] = factory (topic[len (prefix):])
+                return builder
+
+        raise KeyError (topic)
+
+    def remove_factory_topic (self, topic):
+        # Must be called with the lock held.
+        if any (topic.startswith (prefix) for prefix in self.factories):
+            self.builders.pop (topic, None)
+            self.versions.pop (topic, None)
+
+    def encode (self, version, data):
+        return f"id: {self.epoch}-{version}\ndata: {data}\n\n".encode ('utf-8')
+
+    def parse_event_id (self, event_id):
+        epoch, _, version = (event_id or '').partition ('-')
+        if epoch != self.epoch or not version.isdigit ():
+            return 0
+        return int (version)
+
+    def build (self, topic):
+        # Builds run one at a time so an older state can't land after a newer one.
+        with self.build_lock:
+            with self.lock:
+                builder = self.get_builder (topic)
+            if builder is None:
+                return False
+            data = json.dumps (builder ())
+
+            with self.lock:
+                backlog = self.backlogs.setdefault (topic, collections.deque (maxlen=StreamBroker.backlog_size))
+                if backlog and backlog[-1][2] == data:
+                    return False
+
+                version = self.versions.get (topic, 0) + 1
+                self.versions[topic] = version
+                backlog.append ((version, self.encode (version, data), data))
+                subscribers = list (self.subscribers.get (topic, ()))
+
+        for subscriber in subscribers:
+            subscriber.notify ()
+
+        return True
+
+    def publish (self, topic):
+        # Nobody is watching and nobody was a moment ago, the payload is built when someone subscribes.
+        with self.lock:
+            if not self.subscribers.get (topic) and not self.is_idle (topic, time.monotonic ()):
+                self.expire (topic)
+                return
+
+        self.build (topic)
+
+    def publish_matching (self, prefix):
+        with self.lock:
+            topics = [topic for topic in set (self.subscribers) | set (self.idle_since) if topic.startswith (prefix)]
+
+        for topic in topics:
+            self.publish (topic)
+
+    def since (self, topic, version, build=True):
+        # Payloads newer than version. Only the latest one if the backlog doesn't reach back that far,
+        # every payload is the full state. None if nothing is built yet and build is False.
+        with self.lock:
+            backlog = self.backlogs.get (topic)
+            if backlog:
+                return self.backlog_since (backlog, version)
+
+        if not build:
+            return None
+
+        self.build (topic)
+
+        with self.lock:
+            backlog = self.backlogs.get (topic)
+            return self.backlog_since (backlog, version) if backlog else []
+
+    def backlog_since (self, backlog, version):
+        # Must be called with the lock held.
+        latest = backlog[-1]
+        if version == latest[0]:
+            return []
+        if 0 < version < latest[0] and version >= backlog[0][0] - 1:
+            return [(entry[0], entry[1]) for entry in backlog if entry[0] > version]
+        return [(latest[0], latest[1])]
+
+    def subscribe (self, topic, subscriber):
+        with self.lock:
+            self.subscribers.setdefault (topic, set ()).add (subscriber)
+            self.idle_since.pop (topic, None)
+
+    def unsubscribe (self, topic, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get (topic)
+            if subscribers is None:
+                return
+
+            subscribers.discard (subscriber)
+            if not subscribers:
+                del self.subscribers[topic]
+                self.idle_since[topic] = time.monotonic ()
+
+            self.expire_idle (time.monotonic ())
+
+    def is_idle (self, topic, now):
+        # Must be called with the lock held. Whether the topic lost its last subscriber within the grace period.
+        since = self.idle_since.get (topic)
+        return since is not None and now - since < StreamBroker.idle_grace
+
+    def expire (self, topic):
+        # Must be called with the lock held.
+        self.idle_since.pop (topic, None)
+        self.backlogs.pop (topic, None)
+        self.remove_factory_topic (topic)
+
+    def expire_idle (self, now):
+        # Must be called with the lock held.
+        for topic in [topic for topic in self.idle_since if not self.is_idle (topic, now)]:
+            self.expire (topic)
+
+    def subscriber_count (self):
+        with self.lock:
+            return sum (len (subscribers) for subscribers in self.subscribers.values())
+
+class ThreadSubscriber:
+    def __init__ (self):
+        self.event = threading.Event ()
+
+    def notify (self):
+        self.event.set ()
+
+    def wait (self, timeout):
+        self.event.wait (timeout)
+        self.event.clear ()
+
+class AsyncSubscriber:
+    def __init__ (self, loop):
+        self.loop = loop
+        self.event = asyncio.Event ()
+
+    def notify (self):
+        # Called from whichever thread published.
+        self.loop.call_soon_threadsafe (self.event.set)
+
+def raise_open_file_limit ():
+    # Every open stream is a socket, the default soft limit on some systems is 256.
+    try:
+        import resource
+    except ImportError:
+        return
+
+    soft, hard = resource.getrlimit (resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 65536
+    if soft == resource.RLIM_INFINITY or soft >= hard:
+        return
+
+    try:
+        resource.setrlimit (resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        print (f"Could not raise the open file limit from {soft}: {e}")
+
+class StreamServer:
+    # Serves event streams from the broker as coroutines and hands every other request to the WSGI app on a thread pool.
+    keepalive_interval = 15
+    max_header_size = 65536
+    # Nothing the app takes comes close, the largest are server settings forms.
+    max_body_size = 10 * 1024 * 1024
+    request_timeout = 30
+    backlog = 1024
+
+    def __init__ (self, app, broker, get_topic, is_authorized, host, port, threads=8, max_streams=2000):
+        self.app = app
+        self.broker = broker
+        self.get_topic = get_topic
+        self.is_authorized = is_authorized
+        self.host = host
+        self.port = port
+        self.executor = concurrent.futures.ThreadPoolExecutor (max_workers=threads)
+        self.max_streams = max_streams
+        self.streams = 0
+        self.loop = None
+        self.ready = threading.Event ()
+
+    def serve (self):
+        raise_open_file_limit ()
+        asyncio.run (self.run ())
+
+    async def run (self):
+        self.loop = asyncio.get_running_loop ()
+        server = await asyncio.start_server (self.handle_connection, self.host, self.port, limit=StreamServer.max_header_size, backlog=StreamServer.backlog)
+        self.ready.set ()
+        async with server:
+            await server.serve_forever ()
+
+    async def handle_connection (self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request (reader, writer)
+                if request is None:
+                    break
+
+                environ, keep_alive = request
+
+                # get_topic only maps the path, nothing is registered for a request until it is authorized and subscribed.
+                topic = None
+                if environ['REQUEST_METHOD'] == 'GET':
+                    topic = self.get_topic (environ['PATH_INFO'])
+
+                # Unauthorized stream requests go to the app so they get its login redirect.
+                if topic is not None and await self.loop.run_in_executor (self.executor, self.is_authorized, environ):
+                    if self.streams >= self.max_streams:
+                        writer.write (b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 10\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                        await writer.drain ()
+                        break
+
+                    self.streams += 1
+                    try:
+                        await self.serve_stream (topic, environ.get ('HTTP_LAST_EVENT_ID'), reader, writer)
+                    finally:
+                        self.streams -= 1
+                    break
+
+                if not await self.serve_wsgi (environ, writer, keep_alive):
+                    break
+        except BadRequest as e:
+            # The rest of the connection can't be trusted to be framed right, so it is closed.
+            content = e.message.encode ('utf-8')
+            writer.write (f"HTTP/1.1 {e.status}\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Length: {len (content)}\r\nConnection: close\r\n\r\n".encode ('latin-1') + content)
+            try:
+                await writer.drain ()
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close ()
+
+    async def read_request (self, reader, writer):
+        # Idle keep-alive connections and slow senders are dropped instead of being held forever.
+        try:
+            head = await asyncio.wait_for (reader.readuntil (b"\r\n\r\n"), StreamServer.request_timeout)
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise BadRequest ("431 Request Header Fields Too Large", "Request headers are too large.")
+
+        lines = head.decode ('latin-1').split ("\r\n")
+        request_line = lines[0].split (" ")
+        if len (request_line) != 3 or not request_line[0].isalpha () or request_line[2] not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise BadRequest ("400 Bad Request", "Malformed request line.")
+        method, target, version = request_line
+
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition (":")
+            if not separator or not name or name != name.strip ():
+                raise BadRequest ("400 Bad Request", "Malformed header.")
+            name = name.upper().replace ('-', '_')
+            value = value.strip ()
+
+            # A second, different length is how requests get smuggled past a proxy.
+            if name == 'CONTENT_LENGTH' and name in headers and headers[name] != value:
+                raise BadRequest ("400 Bad Request", "Conflicting Content-Length headers.")
+            headers[name] = value
+
+        # Only bodies with a length are read. Guessing where a chunked body ends would let
+        # its bytes be read as the next request.
+        if 'TRANSFER_ENCODING' in headers:
+            raise BadRequest ("400 Bad Request", "Transfer-Encoding is not supported in requests, send a Content-Length.")
+
+        length = headers.get ('CONTENT_LENGTH') or "0"
+        if not (length.isascii () and length.isdigit ()):
+            raise BadRequest ("400 Bad Request", "Invalid Content-Length.")
+        length = int (length)
+        if length > StreamServer.max_body_size:
+            raise BadRequest ("413 Content Too Large", f"Request bodies are limited to {StreamServer.max_body_size} bytes.")
+
+        body = b""
+        if length:
+            if headers.get ('EXPECT', '').lower() == '100-continue':
+                writer.write (b"HTTP/1.1 100 Continue\r\n\r\n")
+            body = await asyncio.wait_for (reader.readexactly (length), StreamServer.request_timeout)
+
+        path, _, query = target.partition ("?")
+        peer = writer.get_extra_info ('peername') or ('', 0)
+
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes (path).decode ('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str (self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str (peer[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO (body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+
+        for name, value in headers.items():
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                environ[f"HTTP_{name}"] = value
+
+        connection = headers.get ('CONNECTION', '').lower ()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+        return environ, keep_alive
+
+    def call_app (self, environ):
+        response = {}
+
+        def start_response (status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        body = self.app (environ, start_response)
+
+        # Without a length the app is streaming, hand the iterable back to be sent as it is produced.
+        if not any (name.lower () == 'content-length' for name, value in response['headers']):
+            return response['status'], response['headers'], None, body
+
+        try:
+            content = b"".join (body)
+        finally:
+            if hasattr (body, 'close'):
+                body.close ()
+
+        return response['status'], response['headers'], content, None
+
+    async def serve_wsgi (self, environ, writer, keep_alive):
+        status, headers, content, body = await self.loop.run_in_executor (self.executor, self.call_app, environ)
+
+        lines = [f"HTTP/1.1 {status}"]
+        for name, value in headers:
+            if name.lower () in ('content-length', 'connection', 'transfer-encoding'):
+                continue
+            lines.append (f"{name}: {value}")
+
+        if body is None:
+            lines.append (f"Content-Length: {len (content)}")
+            lines.append (f"Connection: {'keep-alive' if keep_alive else 'close'}")
+
+            writer.write (("\r\n".join (lines) + "\r\n\r\n").encode ('latin-1') + content)
+            await writer.drain ()
+            return keep_alive
+
+        # HTTP/1.0 has no chunked encoding, the end of the body is the end of the connection.
+        chunked = environ['SERVER_PROTOCOL'] == 'HTTP/1.1'
+        if chunked:
+            lines.append ("Transfer-Encoding: chunked")
+        else:
+            keep_alive = False
+        lines.append (f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        writer.write (("\r\n".join (lines) + "\r\n\r\n").encode ('latin-1'))
+
+        iterator = iter (body)
+        try:
+            while True:
+                chunk = await self.loop.run_in_executor (self.executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+
+                if chunked:
+                    writer.write (f"{len (chunk):x}\r\n".encode ('latin-1') + chunk + b"\r\n")
+                else:
+                    writer.write (chunk)
+                await writer.drain ()
+
+            if chunked:
+                writer.write (b"0\r\n\r\n")
+                await writer.drain ()
+        finally:
+            if hasattr (body, 'close'):
+                await self.loop.run_in_executor (self.executor, body.close)
+
+        return keep_alive
+
+    @staticmethod
+    async def wait_for_close (reader):
+        # Anything the client sends is thrown away a little at a time, so it can't pile up in memory.
+        while await reader.read (1024):
+            pass
+
+    async def serve_stream (self, topic, last_event_id, reader, writer):
+        writer.write (b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        writer.write (f"retry: {StreamBroker.retry_interval}\n\n".encode ('utf-8'))
+
+        # Nothing more is sent on a stream connection, so a finished read means the client went away.
+        closed = asyncio.ensure_future (StreamServer.wait_for_close (reader))
+
+        subscriber = AsyncSubscriber (self.loop)
+        self.broker.subscribe (topic, subscriber)
+        try:
+            version = self.broker.parse_event_id (last_event_id)
+            while True:
+                subscriber.event.clear ()
+
+                events = self.broker.since (topic, version, build=False)
+                if events is None:
+                    # Building can read files, keep it off the loop.
+                    events = await self.loop.run_in_executor (self.executor, self.broker.since, topic, version)
+
+                if events:
+                    version = events[-1][0]
+                    writer.write (b"".join (payload for _, payload in events))
+                    await writer.drain ()
+
+                changed = asyncio.ensure_future (subscriber.event.wait ())
+                done, pending = await asyncio.wait ((changed, closed), timeout=StreamServer.keepalive_interval, return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel ()
+
+                if closed in done:
+                    break
+                if not done:
+                    writer.write (b": keepalive\n\n")
+                    await writer.drain ()
+        finally:
+            closed.cancel ()
+            self.broker.unsubscribe (topic, subscriber)
@@ -14,10 +14,13 @@ import math
 import re
 import time
 import MeshedServer
+import MeshedStreamServer
 from MeshedServer import ServerInfo
 import platformdirs
 import logging
 import waitress
+import argparse
+import collections
 
 app_name = "Meshed Server Tool"
 app_author = "Skomesh"
@@ -36,6 +39,7 @@ app = Flask(__name__)
 CORS(app)
 
 app.config['servers'] = {}
+app.config['server_info_sequence'] = 0
 app.config['new_reports'] = []
 app.config['lock'] = threading.Lock ()
 app.secret_key = secret_key
@@ -96,58 +100,90 @@ def get_encoded_servers():
     }
     return encoded_servers
 
-def get_logs(line_count=10, start_range=0, server=None):
-    global app_name, app_author
+def get_log_file_path ():
+    return os.path.join (platformdirs.user_log_dir(app_name, app_author, ensure_exists=True), "log.txt")
 
-    output_lines = None
+def get_event_store ():
+    global event_store
+
+    # Embedded, the manager's own store.
+    if MeshedServer.event_store is not None:
+        return MeshedServer.event_store
+
+    # The manager creates it, until then log.txt is all there is.
+    if event_store is None:
+        path = os.path.join (platformdirs.user_log_dir(app_name, app_author, ensure_exists=True), MeshedServer.EventStore.file_name)
+        if os.path.exists (path):
+            event_store = MeshedServer.EventStore (path)
+
+    return event_store
+
+def get_report_store ():
+    global report_store
+
+    # Embedded, the manager's own store.
+    if MeshedServer.report_store is not None:
+        return MeshedServer.report_store
+
+    # The manager creates it the first time it runs.
+    if report_store is None:
+        path = os.path.join (data_dir, MeshedServer.ReportStore.file_name)
+        if os.path.exists (path):
+            report_store = MeshedServer.ReportStore (path)
+
+    return report_store
+
+def get_logs(line_count=10, start_range=0, server=None, filters=None):
     try:
-        with open (os.path.join (platformdirs.user_log_dir(app_name, app_author, ensure_exists=True), "log.txt"), 'r') as logs:
-            all_lines = logs.readlines()
-            if server:
-                all_the_server_logs = []
-                for log in all_lines:
-                    match = re.match(r'\[(.*?)\] (.*?) - (.*)', log)
-                    if match:
-                        timestamp, server_name, log_message = match.groups()
-                        if server_name == server:
-                            all_the_server_logs.append(log)
-                output_lines = all_the_server_logs
-            else:
-                output_lines = all_lines 
+        store = get_event_store ()
+        if store is not None:
+            return store.get_lines (line_count, start_range, server, filters)
+
+        # log.txt can only be filtered by server.
+        if filters and filters.get ('server') is not None:
+            server = filters['server']
+
+        # The latest lines only need the end of the file, until something has built the full index.
+        if start_range == 0 and log_index.inode is None:
+            return MeshedServer.read_log_tail (get_log_file_path (), line_count, server)
+        return log_index.get_lines (line_count, start_range, server)
     except PermissionError as e:
         print ("Permission error accessing logs")
     except FileNotFoundError as e:
         print ("FileNotFound error accessing logs. Is the server manager running?")
     except Exception as e:
         print (e)
-    
-    if output_lines:
-        if start_range >= len(output_lines):
-            return []  
-        
-        output_lines.reverse()
 
-        end_range = min(start_range + line_count, len(output_lines))
+    return []
 
-        return output_lines[start_range:end_range]
-    else:
-        return []
-
-def read_log_pages (page_size=10):
-    global app_name, app_author
+def read_log_pages (page_size=10, filters=None):
     line_count = 0
 
     try:
-        with open(os.path.join (platformdirs.user_log_dir(app_name, app_author, ensure_exists=True), "log.txt"), 'r') as file:
-            line_count = sum(1 for _ in file)
+        store = get_event_store ()
+        if store is not None:
+            line_count = store.count_events (filters=filters)
+        else:
+            line_count = log_index.line_count ((filters or {}).get ('server'))
     except PermissionError as e:
         print ("Permission error accessing logs")
-    except FileNotFoundError as e:
-        print ("FileNotFound error accessing logs")
     except Exception as e:
         print (e)
 
     return math.ceil (line_count / page_size)
+
+log_index = MeshedServer.LogIndex (get_log_file_path ())
+
+def warn_log_archive (message):
+    # log.txt belongs to the server manager, only write to it when it runs in this process.
+    if embedded_manager:
+        MeshedServer.write_to_log_error (message, MeshedServer.LogLevel.WARNING, method="LogArchive.read_history()")
+    else:
+        print (message)
+
+log_archive = MeshedServer.LogArchive (os.path.dirname (get_log_file_path ()), on_warning=warn_log_archive)
+event_store = None
+report_store = None
     
 def get_lock():
     return app.config['lock']
@@ -160,22 +196,17 @@ def update_server_info():
     try:
         data = request.json
 
-        if 'server_info' not in data:
-            raise ValueError('Missing "server_info" key in JSON data')
-        
-        server_info_data = json.loads(data['server_info'])     
+        if 'sequence' not in data:
+            raise ValueError('Missing "sequence" key in JSON data')
 
         with app.app_context():
             with get_lock():
-                get_servers().clear()
+                if not apply_server_info_update (data):
+                    return jsonify({'status': 'resync', 'sequence': app.config['server_info_sequence']}), 409
 
-                for info in server_info_data:
-                    server_name = info['server_name']
-                    server_obj = ServerInfo(name=server_name)
-                    server_obj.__dict__.update(info)
-                    get_servers()[server_name] = server_obj
+            server_info_changed ()
             
-            response_data = {'servers': []}
+            response_data = {'servers': [], 'sequence': data['sequence']}
 
             with get_lock():
                 for server_name, server in get_servers().items():
@@ -193,6 +224,37 @@ def update_server_info():
             print(f"Error updating server info: {e}, {data}")
             return 'Error updating server info', 500
 
+def apply_server_info_update (update):
+    # Must be called with the lock held. Returns False if an update was missed and a full one is needed.
+    servers = get_servers()
+
+    if not update['full'] and update['previous_sequence'] != app.config['server_info_sequence']:
+        return False
+
+    if update['full']:
+        servers.clear()
+
+    for server_name, change in update['servers'].items():
+        server = servers.get (server_name)
+        if server is None:
+            server = ServerInfo(name=server_name)
+            servers[server_name] = server
+
+        server.__dict__.update (change['set'])
+        for field, items in change['add'].items():
+            current = getattr (server, field)
+            if isinstance (current, set):
+                current.update (items)
+            else:
+                current.extend (items)
+        server.version = change['version']
+
+    for server_name in update['removed']:
+        servers.pop (server_name, None)
+
+    app.config['server_info_sequence'] = update['sequence']
+    return True
+
 @app.route('/receive_new_reports', methods=['POST'])
 def receive_new_reports():
     if not request.data:
@@ -202,12 +264,7 @@ def receive_new_reports():
         data = request.get_json()
         reports_data = json.loads (data)
 
-        lock = get_lock ()
-        with lock:
-            app.config['new_reports'].clear()
-
-            for report in reports_data:
-                app.config['new_reports'].append (report)
+        set_new_reports (reports_data)
 
         return 'Sucess', 200
 
@@ -217,98 +274,175 @@ def receive_new_reports():
             print(f"Error receiving report info: {e}, {data}")
             return 'Error receiving report info', 500
 
-@app.route('/stream_server_info')
-@login_required
-def stream_server_info():
+@app.route('/receive_new_report', methods=['POST'])
+def receive_new_report():
+    if not request.data:
+        return jsonify({'status': 'failed', 'message': 'Empty data received'}), 204
+
+    try:
+        add_new_report (json.loads (request.get_json()))
+        return 'Sucess', 200
+    except JSONDecodeError as e:
+        return jsonify({'status': 'error', 'message': 'Invalid JSON data received'}), 400
+    except Exception as e:
+        print(f"Error receiving report: {e}")
+        return 'Error receiving report', 500
+
+def add_new_report (report):
+    with get_lock ():
+        if any (existing['hash'] == report['hash'] for existing in app.config['new_reports']):
+            return
+        app.config['new_reports'].append (report)
+
+    reports_changed ()
+
+def set_new_reports (reports_data):
+    lock = get_lock ()
+    with lock:
+        app.config['new_reports'].clear()
+
+        for report in reports_data:
+            app.config['new_reports'].append (report)
+
+    reports_changed ()
+
+def get_server_info_dicts ():
+    with get_lock():
+        return {
+            server_name: {
+                'server_name': server.name,
+                'current_users': server.current_users,
+                'server_status': server.server_status,
+                'gamemode_changes': server.gamemode_changes,
+                'server_restarts' : server.server_restarts,
+                'current_game': server.current_game,
+                'current_gamemode': server.current_gamemode,
+                'previous_game': server.previous_game,
+                'current_checkpoint': server.current_checkpoint,
+                'last_completed_objective': server.last_completed_objective,
+                'player_deaths': server.player_deaths,
+                'game_attempts': server.game_attempts
+            }
+            for server_name, server in get_servers().items()
+        }
+
+def get_locked_encoded_servers ():
+    with get_lock():
+        return get_encoded_servers()
+
+def get_new_reports_quantity ():
+    with get_lock():
+        return len (app.config['new_reports'])
+
+def get_new_reports ():
+    with get_lock():
+        return list (app.config['new_reports'])
+
+stream_broker = MeshedStreamServer.StreamBroker ()
+stream_broker.register ("server_info", get_server_info_dicts)
+stream_broker.register ("server_info_encoded", get_locked_encoded_servers)
+stream_broker.register ("all_server_logs", get_logs)
+stream_broker.register ("new_reports_quantity", get_new_reports_quantity)
+stream_broker.register ("new_reports", get_new_reports)
+
+stream_paths = {
+    '/stream_server_info': "server_info",
+    '/stream_server_info_encoded': "server_info_encoded",
+    '/stream_all_server_logs': "all_server_logs",
+    '/stream_new_reports_quantity': "new_reports_quantity",
+    '/stream_new_reports': "new_reports"
+}
+
+def get_server_logs_topic (server_name):
+    # The builder is made by the broker when the topic is subscribed to, see the factory below.
+    return f"server_logs/{server_name}"
+
+def make_server_logs_builder (server_name):
+    return lambda: get_logs(server=server_name)
+
+stream_broker.register_factory ("server_logs/", make_server_logs_builder)
+
+def get_stream_topic (path):
+    if path in stream_paths:
+        return stream_paths[path]
+
+    match = re.fullmatch (r'/server/([^/]+)/stream_server_logs', path)
+    if match:
+        # WSGI paths are latin-1, server names can be anything.
+        return get_server_logs_topic (match.group(1).encode ('latin-1').decode ('utf-8', 'replace'))
+
+    return None
+
+def is_stream_authorized (environ):
+    with app.request_context (environ):
+        return current_user.is_authenticated
+
+def server_info_changed ():
+    stream_broker.publish ("server_info")
+    stream_broker.publish ("server_info_encoded")
+
+def reports_changed ():
+    stream_broker.publish ("new_reports_quantity")
+    stream_broker.publish ("new_reports")
+
+def log_file_changed (path):
+    stream_broker.publish ("all_server_logs")
+    stream_broker.publish_matching ("server_logs/")
+
+def stream_response (topic):
+    # Used when the routes are served by waitress, StreamServer answers these paths itself.
+    last_event_id = request.headers.get ('Last-Event-ID')
+
     def generate():
-        with app.app_context():
+        yield f"retry: {MeshedStreamServer.StreamBroker.retry_interval}\n\n".encode ('utf-8')
+
+        subscriber = MeshedStreamServer.ThreadSubscriber ()
+        stream_broker.subscribe (topic, subscriber)
+        try:
+            version = stream_broker.parse_event_id (last_event_id)
             while True:
-                server_info = get_servers()
-                server_info_dicts = {
-                    server_name: {
-                        'server_name': server.name,
-                        'current_users': server.current_users,
-                        'server_status': server.server_status,
-                        'gamemode_changes': server.gamemode_changes,
-                        'server_restarts' : server.server_restarts,
-                        'current_game': server.current_game,
-                        'current_gamemode': server.current_gamemode,
-                        'previous_game': server.previous_game,
-                        'current_checkpoint': server.current_checkpoint,
-                        'last_completed_objective': server.last_completed_objective,
-                        'player_deaths': server.player_deaths,
-                        'game_attempts': server.game_attempts
-                    }
-                    for server_name, server in server_info.items()
-                }
-                yield f"data: {json.dumps(server_info_dicts)}\n\n"
+                events = stream_broker.since (topic, version)
+                if events:
+                    version = events[-1][0]
+                    yield b"".join (payload for _, payload in events)
+                else:
+                    yield b": keepalive\n\n"
 
-                time.sleep(1)
+                subscriber.wait (MeshedStreamServer.StreamServer.keepalive_interval)
+        finally:
+            stream_broker.unsubscribe (topic, subscriber)
 
     return Response(generate(), mimetype='text/event-stream')
 
+@app.route('/stream_server_info')
+@login_required
+def stream_server_info():
+    return stream_response ("server_info")
+
 @app.route('/stream_server_info_encoded')
 @login_required
 def stream_server_info_encoded():
-    def generate():
-        with app.app_context():
-            while True:
-                server_info = get_encoded_servers()
-                yield f"data: {json.dumps(server_info)}\n\n"
-
-                time.sleep(1)
-
-    return Response(generate(), mimetype='text/event-stream')
+    return stream_response ("server_info_encoded")
 
 @app.route('/stream_all_server_logs')
 @login_required
 def stream_all_server_logs():
-    def generate():
-        with app.app_context():
-            while True:
-                logs = get_logs()
-                yield f"data: {json.dumps(logs)}\n\n"
-
-                time.sleep (2)
-    return Response(generate(), mimetype='text/event-stream')
+    return stream_response ("all_server_logs")
 
 @app.route('/server/<server_name>/stream_server_logs')
 @login_required
 def stream_server_logs(server_name):
-    def generate():
-        with app.app_context():
-            while True:
-                logs = get_logs(server=server_name)
-                yield f"data: {json.dumps(logs)}\n\n"
-
-                time.sleep (2)
-    return Response(generate(), mimetype='text/event-stream')
+    return stream_response (get_server_logs_topic (server_name))
 
 @app.route ('/stream_new_reports_quantity')
 @login_required
 def stream_new_reports_quantity ():
-    def generate():
-        with app.app_context():
-            while True:
-                lock = get_lock()
-                with lock:
-                    yield f"data: {json.dumps(len (app.config['new_reports']))}\n\n"
-
-                time.sleep (3)
-    return Response (generate(), mimetype='text/event-stream')
+    return stream_response ("new_reports_quantity")
 
 @app.route ('/stream_new_reports')
 @login_required
 def stream_new_reports ():
-    def generate():
-        with app.app_context():
-            while True:
-                lock = get_lock()
-                with lock:
-                    yield f"data: {json.dumps(app.config['new_reports'])}\n\n"
-
-                time.sleep (7)
-    return Response (generate(), mimetype='text/event-stream')
+    return stream_response ("new_reports")
 
 @app.route('/')
 @login_required
@@ -411,7 +545,11 @@ def web_server_logs_page (page=1):
 def get_log_pages ():
     data = request.get_json ()
     page = data.get ("page_size")
-    return jsonify (read_log_pages (page))
+    try:
+        filters = get_log_filters (data.get ("filters") or {})
+    except ValueError as e:
+        return jsonify ({'status': 'error', 'message': str (e)}), 400
+    return jsonify (read_log_pages (page, filters))
 
 @app.route ('/logs/get_logs', methods=['POST'])
 @login_required
@@ -419,7 +557,136 @@ def get_page_logs ():
     data = request.get_json()
     page = data.get ("page")
     page_size = data.get ("page_size")
-    return jsonify (get_logs (line_count=page_size, start_range=((page - 1) * page_size)))
+    try:
+        filters = get_log_filters (data.get ("filters") or {})
+    except ValueError as e:
+        return jsonify ({'status': 'error', 'message': str (e)}), 400
+    return jsonify (get_logs (line_count=page_size, start_range=((page - 1) * page_size), filters=filters))
+
+@app.route ('/logs/query', methods=['GET', 'POST'])
+@login_required
+def query_logs ():
+    values = request.get_json (silent=True) if request.is_json else request.args
+    if request.is_json and not isinstance (values, dict):
+        return jsonify ({'status': 'error', 'message': 'The request body must be a JSON object'}), 400
+
+    store = get_event_store ()
+    if store is None:
+        return jsonify ({'status': 'error', 'message': 'No event store yet. Is the server manager running?'}), 503
+
+    cursor = values.get ("cursor")
+    after = values.get ("after")
+    export = values.get ("format") == "ndjson"
+
+    try:
+        filters = get_log_filters (values)
+        # An export has no page size, a limit caps how many events it has in total.
+        if export:
+            limit = int (values["limit"]) if values.get ("limit") is not None else None
+            if limit is not None and limit < 1:
+                raise ValueError ("limit must be at least 1")
+        else:
+            limit = max (1, min (int (values.get ("limit", 100)), 1000))
+        for position in (cursor, after):
+            if position:
+                MeshedServer.EventStore.decode_cursor (position)
+    except (TypeError, ValueError) as e:
+        return jsonify ({'status': 'error', 'message': str (e)}), 400
+
+    if export:
+        if after:
+            return jsonify ({'status': 'error', 'message': 'after is not supported with format=ndjson, export from a cursor instead'}), 400
+        return Response (stream_log_query (store, filters, cursor, limit), mimetype='application/x-ndjson')
+
+    events = store.query_events (filters, before=cursor or None, after=after or None, limit=limit)
+
+    return jsonify ({
+        'events': events,
+        # Pass as cursor for the next, older page. None once there is nothing older.
+        'next_cursor': events[-1]['cursor'] if len (events) == limit else None,
+        # Pass as after to get only what was logged since.
+        'newest_cursor': events[0]['cursor'] if events else after
+    })
+
+def get_log_filters (values):
+    # Raises ValueError for filters of the wrong type.
+    filters = {}
+
+    for field in ('server', 'text'):
+        value = values.get (field)
+        if value and not isinstance (value, str):
+            raise ValueError (f"{field} must be a string")
+        if value:
+            filters[field] = value
+
+    for field in ('severity', 'event_type'):
+        value = values.get (field)
+        if isinstance (value, str):
+            value = [item for item in value.split (',') if item]
+        elif value is not None and not (isinstance (value, list) and all (isinstance (item, str) for item in value)):
+            raise ValueError (f"{field} must be a name, a comma separated list or a list of names")
+        if value:
+            filters[field] = value
+
+    for field in ('start', 'end'):
+        if values.get (field) not in (None, ''):
+            filters[field] = parse_timestamp (values.get (field), field)
+
+    return filters
+
+def parse_timestamp (value, field):
+    # Unix timestamps from a request. Raises ValueError for anything else, NaN and infinity included.
+    if isinstance (value, bool):
+        raise ValueError (f"{field} must be a unix timestamp")
+    try:
+        timestamp = float (value)
+    except (TypeError, ValueError):
+        raise ValueError (f"{field} must be a unix timestamp")
+    if not math.isfinite (timestamp):
+        raise ValueError (f"{field} must be a finite unix timestamp")
+    return timestamp
+
+def stream_log_query (store, filters, cursor, limit=None, batch_size=1000):
+    # Everything that matches, or the first limit events, one JSON object per line, fetched a batch at a time.
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min (batch_size, remaining)
+        events = store.query_events (filters, before=cursor or None, limit=size)
+        if events:
+            yield "".join (json.dumps (event) + "\n" for event in events)
+
+        if remaining is not None:
+            remaining -= len (events)
+        if len (events) < size:
+            break
+        cursor = events[-1]['cursor']
+
+@app.route ('/logs/get_history', methods=['POST'])
+@login_required
+def get_history_logs ():
+    data = request.get_json (silent=True)
+    if not isinstance (data, dict):
+        return jsonify ({'status': 'error', 'message': 'Expected a JSON object'}), 400
+
+    try:
+        filters = get_log_filters (data)
+    except ValueError as e:
+        return jsonify ({'status': 'error', 'message': str (e)}), 400
+    start = filters.get ("start")
+    end = filters.get ("end")
+    server = filters.get ("server")
+    try:
+        limit = max (1, min (int (data.get ("limit", 1000)), 10000))
+    except (TypeError, ValueError):
+        return jsonify ({'status': 'error', 'message': 'limit must be an integer'}), 400
+
+    # Newest first like get_logs, only the last lines of the window are kept.
+    lines = collections.deque (maxlen=limit)
+    for event in log_archive.read_history (start, end, server):
+        lines.append (MeshedServer.EventStore.format_event (event[:6]))
+
+    lines.reverse ()
+    return jsonify (list (lines))
 
 @app.route ('/control_server', methods=['POST'])
 @login_required
@@ -514,6 +781,9 @@ def reports_delete_report ():
     try: 
         data = request.get_data (as_text=True)
         response = send_server_control ("delete_report", None, hash=data)
+        with get_lock ():
+            app.config['new_reports'] = [obj for obj in app.config['new_reports'] if obj['hash'] != data]
+        reports_changed ()
         return jsonify (response['message']), response['status']
     except Exception as e:
         return jsonify ({"status": "error", "message": str(traceback.format_exc())}), 500
@@ -527,17 +797,132 @@ def reports_read_report ():
         lock = get_lock ()
         with lock:
             app.config['new_reports'] = [obj for obj in app.config['new_reports'] if obj['hash'] != data]
+        reports_changed ()
         return jsonify (response['message']), response['status']
     except Exception as e:
         return jsonify ({"status": "error", "message": str(traceback.format_exc())}), 500
 
-def get_game_server_config (server):
-    server_config = get_game_server_config_paths (server)
+@app.route ('/reports/unread', methods=['POST'])
+@login_required
+def reports_unread_report ():
+    try:
+        data = request.get_data (as_text=True)
+        response = send_server_control ("unread_report", None, hash=data)
+        return jsonify (response['message']), response['status']
+    except Exception as e:
+        return jsonify ({"status": "error", "message": str(traceback.format_exc())}), 500
 
-    config = configparser.ConfigParser()
-    config.read (server_config)
+@app.route ('/reports/archive')
+@login_required
+def reports_archive ():
+    # Every stored report, filtered by status (read or unread), server, target_id, source_id, start and end.
+    store = get_report_store ()
+    if store is None:
+        return jsonify ({'status': 'error', 'message': 'No report archive yet. Is the server manager running?'}), 503
 
-    return config
+    filters = {field: request.args.get (field) for field in ('status', 'server', 'target_id', 'source_id')}
+    try:
+        for field in ('start', 'end'):
+            if request.args.get (field):
+                filters[field] = float (request.args.get (field))
+        page, page_size = get_report_page (request.args)
+    except ValueError as e:
+        return jsonify ({'status': 'error', 'message': str (e)}), 400
+
+    reports, total = store.get_reports (filters, page, page_size)
+    return jsonify ({'reports': reports, 'total': total, 'page': page, 'page_size': page_size})
+
+@app.route ('/reports/player/<player_id>')
+@login_required
+def reports_for_player (player_id):
+    # Reports against a player, or with role=source the ones they made.
+    store = get_report_store ()
+    if store is None:
+        return jsonify ({'status': 'error', 'message': 'No report archive yet. Is the server manager running?'}), 503
+
+    field = 'source_id' if request.args.get ('role') == 'source' else 'target_id'
+    try:
+        page, page_size = get_report_page (request.args)
+    except ValueError as e:
+        return jsonify ({'status': 'error', 'message': str (e)}), 400
+
+    reports, total = store.get_reports ({field: player_id, 'status': request.args.get ('status')}, page, page_size)
+    return jsonify ({'reports': reports, 'total': total, 'page': page, 'page_size': page_size})
+
+@app.route ('/reports/top')
+@login_required
+def reports_top_reported ():
+    store = get_report_store ()
+    if store is None:
+        return jsonify ({'status': 'error', 'message': 'No report archive yet. Is the server manager running?'}), 503
+
+    try:
+        days = float (request.args.get ('days', 7))
+        page, page_size = get_report_page (request.args, default_size=20)
+    except ValueError as e:
+        return jsonify ({'status': 'error', 'message': str (e)}), 400
+
+    players, total = store.get_top_reported (days, page, page_size)
+    return jsonify ({'players': players, 'total': total, 'page': page, 'page_size': page_size, 'days': days})
+
+def get_report_page (values, default_size=50):
+    page = max (1, int (values.get ('page', 1)))
+    page_size = max (1, min (int (values.get ('page_size', default_size)), 500))
+    return page, page_size
+
+class ServerConfigCache:
+    # Config paths by server name, and parsed configs by path and modification time.
+    # Cached configs are shared, anything that changes a config reads its own copy.
+    def __init__ (self):
+        self.paths = {}
+        self.configs = {}
+        self.lock = threading.Lock ()
+
+    def get_path (self, server, fetch):
+        with self.lock:
+            path = self.paths.get (server)
+
+        if path is None:
+            path = fetch (server)
+            with self.lock:
+                self.paths[server] = path
+
+        return path
+
+    def read (self, path):
+        modified = os.stat (path).st_mtime_ns
+
+        with self.lock:
+            cached = self.configs.get (path)
+            if cached is not None and cached[0] == modified:
+                return cached[1]
+
+        config = configparser.ConfigParser()
+        config.read (path)
+
+        with self.lock:
+            self.configs[path] = (modified, config)
+
+        return config
+
+    def invalidate (self, server):
+        with self.lock:
+            path = self.paths.pop (server, None)
+            if path is not None:
+                self.configs.pop (path, None)
+
+server_config_cache = ServerConfigCache ()
+
+def get_server_config (server):
+    try:
+        return server_config_cache.read (get_server_config_paths (server))
+    except FileNotFoundError:
+        # Renamed or recreated without the manager telling us, ask it again.
+        server_config_cache.invalidate (server)
+        return MeshedServer.read_config (get_server_config_paths (server))
+
+def get_game_server_config (server):
+    return server_config_cache.read (get_game_server_config_paths (server))
 
 def get_game_server_config_from_path (server_path):
     config = configparser.ConfigParser()
@@ -546,8 +931,7 @@ def get_game_server_config_from_path (server_path):
     return config
 
 def get_game_server_config_paths (server):
-    path = get_server_config_paths (server)
-    config = MeshedServer.read_config (path)
+    config = get_server_config (server)
 
     saved_path = config['General']['saved_path_dont_touch']
     shared_dir = config['General']['shared_install_dir']
@@ -560,8 +944,7 @@ def get_game_server_config_paths (server):
     return server_config
 
 def get_management_settings (server):
-    path = get_server_config_paths (server)
-    config = MeshedServer.read_config (path)
+    config = get_server_config (server)
     config_dict = {}
     for section in config.sections():
         config_dict[section] = {}
@@ -571,8 +954,7 @@ def get_management_settings (server):
     return config_dict
 
 def get_players_settings (server):
-    path = get_server_config_paths (server)
-    config = MeshedServer.read_config (path)
+    config = get_server_config (server)
     saved_path = config['General']['saved_path_dont_touch']
     admin_list = []
     owner_list = []
@@ -626,14 +1008,18 @@ def get_gameplay_settings (server):
     return settings_dict
 
 def get_server_config_paths (server):
+    return server_config_cache.get_path (server, request_server_config_path)
+
+def request_server_config_path (server):
     action = 'get_server_config'
     server = server
 
     response = send_server_control (action, server)
+
+    if response['status'] != 200:
+        raise RuntimeError (response['message'])
     
-    response_data = json.loads(response['response'].decode('utf-8'))
-    
-    return response_data
+    return response['response']
 
 def apply_management_settings (server, settings):
     try:
@@ -652,8 +1038,7 @@ def apply_management_settings (server, settings):
 
 def apply_players_settings (server, settings):
     try:
-        path = get_server_config_paths (server)
-        config = MeshedServer.read_config (path)
+        config = get_server_config (server)
 
         saved_path = config['General']['saved_path_dont_touch']
 
@@ -718,6 +1103,138 @@ def apply_gameplay_settings (server, settings):
         return {"status": "error", "message": str(e)}, 500
 
 
+class ControlChannel:
+    # Persistent connection to the server manager. Requests carry an id so several can be in flight at once.
+    request_timeout = 60
+
+    def __init__ (self):
+        self.socket = None
+        self.lock = threading.Lock ()
+        self.pending = {}
+        self.next_id = 0
+
+    reconnect_interval = 2
+
+    def get_address (self):
+        return MeshedServer.get_control_address (MeshedServer.get_global_config(), connect=True)
+
+    def connect (self):
+        # Must be called with the lock held.
+        if self.socket is not None:
+            return self.socket
+
+        family, address = self.get_address ()
+        client_socket = socket.socket (family, socket.SOCK_STREAM)
+        try:
+            client_socket.connect (address)
+        except OSError:
+            client_socket.close ()
+            raise
+
+        self.socket = client_socket
+        threading.Thread (target=self.read_loop, args=(client_socket,), daemon=True).start ()
+        return client_socket
+
+    def read_loop (self, client_socket):
+        try:
+            while True:
+                message = MeshedServer.recv_frame (client_socket)
+                if message is None:
+                    break
+
+                if 'event' in message:
+                    self.handle_event (message)
+                    continue
+
+                waiter = self.pending.get (message.get ('id'))
+                if waiter is not None:
+                    waiter['response'] = message
+                    waiter['event'].set ()
+        except (OSError, ValueError) as e:
+            print (f"Control channel closed: {e}")
+        finally:
+            with self.lock:
+                if self.socket is client_socket:
+                    self.socket = None
+            client_socket.close ()
+
+            # Anything still waiting on this connection will never get an answer.
+            for waiter in list (self.pending.values()):
+                if waiter['socket'] is client_socket:
+                    waiter['event'].set ()
+
+    def handle_event (self, message):
+        # Pushed by the manager when the channel runs over a unix socket, instead of the HTTP routes.
+        handle_manager_event (message['event'], message['data'])
+
+    def keep_connected (self):
+        # The manager can only push to a web server that is connected.
+        while True:
+            with self.lock:
+                try:
+                    self.connect ()
+                except OSError:
+                    pass
+            time.sleep (ControlChannel.reconnect_interval)
+
+    def start (self):
+        threading.Thread (target=self.keep_connected, daemon=True).start ()
+
+    def request (self, payload):
+        waiter = {'event': threading.Event (), 'response': None, 'socket': None}
+
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            payload['id'] = request_id
+            self.pending[request_id] = waiter
+
+            try:
+                client_socket = self.connect ()
+                waiter['socket'] = client_socket
+                MeshedServer.send_frame (client_socket, payload)
+            except OSError:
+                self.pending.pop (request_id, None)
+                if self.socket is not None:
+                    self.socket.close ()
+                    self.socket = None
+                raise
+
+        try:
+            if not waiter['event'].wait (ControlChannel.request_timeout):
+                raise TimeoutError (f"No response to {payload['action']} after {ControlChannel.request_timeout} seconds")
+        finally:
+            self.pending.pop (request_id, None)
+
+        if waiter['response'] is None:
+            raise ConnectionError ("Connection to the server manager was lost")
+
+        return waiter['response']
+
+control_channel = ControlChannel ()
+embedded_manager = False
+
+def handle_manager_event (event, data):
+    if event == "server_info":
+        with get_lock():
+            applied = apply_server_info_update (data)
+
+        if applied:
+            server_info_changed ()
+
+        # Asking from the channel's reader thread would deadlock, it is the one that reads the answer.
+        if not applied:
+            threading.Thread (target=send_server_control, args=("resync",), daemon=True).start ()
+    elif event == "new_reports":
+        set_new_reports (data)
+    elif event == "new_report":
+        add_new_report (data)
+    elif event == "server_renamed":
+        server_config_cache.invalidate (data['old_name'])
+        server_config_cache.invalidate (data['new_name'])
+    elif event == "server_created":
+        server_config_cache.invalidate (data['server_name'])
+
 def send_server_control (action, server=None, **kwargs):
     
     payload = {
@@ -727,25 +1244,15 @@ def send_server_control (action, server=None, **kwargs):
 
     payload.update (kwargs)
 
-    payload_json = json.dumps (payload)
-    
-    if len(payload_json) > 4096:  # Adjust buffer size as needed
-            raise ValueError("Data too large to send")
-
-    server_socket = ('127.0.0.1', int (MeshedServer.get_global_config()['WebServer']['web_server_port']) + 1)
+    # Same process as the manager, call it directly.
+    if embedded_manager:
+        response = MeshedServer.run_control_request (payload)
+        return {"status": response['status'], "message": response['message'], "response": response.get ('response')}
 
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect(server_socket)
-            client_socket.sendall(payload_json.encode ('utf-8'))
-            response = b""
-            while True:
-                part = client_socket.recv(1024)
-                if not part:
-                    break
-                response += part
-            return {"status": 200, "message": "Success", "response": response}
-    except socket.error as e:
+        response = control_channel.request (payload)
+        return {"status": response['status'], "message": response['message'], "response": response.get ('response')}
+    except (socket.error, ConnectionError) as e:
         return {"status": 500, "message": f"Socket error: {e}"}
     except Exception as e:
         return {"status": 500, "message": f"Unexpected error {e}"}
@@ -758,13 +1265,43 @@ def read_global_config ():
     else:
         return None
 
+def start_embedded_manager ():
+    global embedded_manager
+
+    embedded_manager = True
+    MeshedServer.local_event_handlers.append (handle_manager_event)
+
+    # Starting servers can block on a missing install directory, don't hold up the web interface for it.
+    threading.Thread (target=MeshedServer.start_manager, kwargs={'embedded': True}, daemon=True).start ()
+
 def main ():
+    parser = argparse.ArgumentParser (description="Meshed Server Tool web interface")
+    parser.add_argument ("--embedded", action="store_true", help="Run the server manager inside this process instead of MeshedServer.py")
+    args = parser.parse_args ()
+
     logging.basicConfig(level=logging.ERROR)
     logger = logging.getLogger('waitress')
     logger.setLevel (logging.ERROR)
     config = MeshedServer.get_global_config ()
     web_server_port = config['WebServer']['web_server_port']
-    waitress.serve (app, listen=f"0.0.0.0:{web_server_port}", threads=8)
+
+    if args.embedded or config['WebServer'].get ('embedded_manager', 'False') == 'True':
+        start_embedded_manager ()
+    else:
+        control_channel.start ()
+
+    # One watch for everyone viewing logs, instead of every stream rereading log.txt.
+    MeshedServer.file_watcher.watch_file (get_log_file_path (), log_file_changed)
+    MeshedServer.file_watcher.start ()
+
+    web_server_mode = config['WebServer'].get ('web_server_mode', 'async')
+    if web_server_mode == 'waitress':
+        # Every open stream holds one of these threads.
+        waitress.serve (app, listen=f"0.0.0.0:{web_server_port}", threads=8)
+    else:
+        max_streams = int (config['WebServer'].get ('max_stream_connections', 2000))
+        stream_server = MeshedStreamServer.StreamServer (app, stream_broker, get_stream_topic, is_stream_authorized, "0.0.0.0", int (web_server_port), threads=8, max_streams=max_streams)
+        stream_server.serve ()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file